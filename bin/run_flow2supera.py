@@ -7,21 +7,65 @@ from optparse import OptionParser
 parser = OptionParser(usage='Provide option flags followed by a list of input files.')
 parser.add_option("-o", "--output", dest="output_filename", metavar="FILE",
                   help="Output (LArCV) filename")
+parser.add_option("--format", dest="output_format", metavar="FORMAT", default='larcv',
+                  help="output format: larcv (ROOT) or hdf5 (flat columnar datasets)")
 parser.add_option("-c", "--config", dest="config", metavar='FILE/KEYWORD', default='',
                   help="Configuration keyword or a file path (full or relative including the file name)")
 parser.add_option("-n", "--num_events", dest="num_events", metavar="INT", default=-1,
                   help="number of events to process")
 parser.add_option("-f", "--num_flash_events", dest="num_flash_events", metavar="INT", default=-1,
-                  help="number of flash events to process")
+                  help="unused: flashes are stored with the charge events they belong to")
 parser.add_option("-s", "--skip", dest="skip", metavar="INT", default=0,
                   help="number of first events to skip")
 parser.add_option("-x", "--num_flash_skip", dest="num_flash_skip", metavar="INT", default=0,
-                  help="number of first flash events to skip")
+                  help="unused: flashes are stored with the charge events they belong to")
 parser.add_option("-l", "--log", dest="log_file", metavar="FILE", default='',
                   help="the name of a log file to be created. ")
+parser.add_option("-w", "--workers", dest="workers", metavar="INT", default=1,
+                  help="number of worker processes; events are split into contiguous shards and merged in order")
+parser.add_option("--batches", dest="batches_per_worker", metavar="INT", default=4,
+                  help="with -w, number of cost-balanced shards per worker; shards are handed out most expensive first")
+parser.add_option("-p", "--prefetch", dest="prefetch", metavar="INT", default=0,
+                  help="number of events to read ahead on a background thread (0 disables the read/store pipeline)")
+parser.add_option("--truth_index", dest="truth_index", action="store_true", default=False,
+                  help="build an event->segment/trajectory index once per file instead of resolving truth per event")
+parser.add_option("--truth_index_dir", dest="truth_index_dir", metavar="DIR", default=None,
+                  help="directory where truth indices are cached and reused across runs (implies --truth_index)")
+parser.add_option("-k", "--checkpoint", dest="checkpoint_interval", metavar="INT", default=0,
+                  help="commit the output every INT entries so that an interrupted run can be resumed by rerunning it")
+parser.add_option("--profile", dest="profile_file", metavar="FILE", default=None,
+                  help="CSV file to stream per-event stage timers and counters to; a summary is printed at the end")
+parser.add_option("--column_store", dest="column_store_dir", metavar="DIR", default=None,
+                  help="export hits and truth tables once to uncompressed .npy files in DIR and memory-map them")
+parser.add_option("--block_cache", dest="block_cache_mb", metavar="MB", default=0,
+                  help="size of the chunk-aligned LRU cache of hit and backtrack blocks (0 disables)")
+parser.add_option("--rdcc_mb", dest="rdcc_mb", metavar="MB", default=0,
+                  help="h5py raw data chunk cache size per dataset (0 keeps the h5py default)")
+parser.add_option("--rdcc_nslots", dest="rdcc_nslots", metavar="INT", default=0,
+                  help="number of h5py chunk cache hash slots, ideally a prime ~100x the chunks held (0 keeps the default)")
+parser.add_option("--all_fields", dest="read_all_fields", action="store_true", default=False,
+                  help="read every field of the hit and truth datasets instead of only those the conversion uses (debugging)")
+parser.add_option("--no_flash", dest="read_flashes", action="store_false", default=True,
+                  help="do not read light events (the opflash product is left empty)")
+parser.add_option("--flash_match", dest="flash_match", metavar="ref/time", default='ref',
+                  help="attach flashes through the flow's charge->light references (ref) or by time (time)")
+parser.add_option("--flash_window", dest="flash_window", metavar="LO,HI", default='0,0',
+                  help="with --flash_match time, flashes with tai_ns within [t+LO, t+HI] ns of the event time t are attached")
+parser.add_option("--flash_time_scale", dest="flash_time_scale", metavar="FLOAT", default=1.,
+                  help="ns per unit of the charge event ts_start, to convert it to the flash time scale")
+parser.add_option("--cache_truth", dest="cache_truth", action="store_true", default=False,
+                  help="load the whole-file truth tables into memory once instead of per event")
+parser.add_option("--event_ids", dest="event_ids", metavar="LIST/FILE", default=None,
+                  help="only convert these event IDs: a comma separated list or a text file with one ID per line")
+parser.add_option("--min_hits", dest="min_hits", metavar="INT", default=0,
+                  help="only convert events with at least INT hits")
+parser.add_option("--server", dest="server", metavar="ADDRESS", default=None,
+                  help="send the job to a run_flow2supera_server.py at ADDRESS (socket path or host:port) instead of running it here")
 
 (data, args) = parser.parse_args()
 
+flow2supera.log.setup_logging()
+
 if os.path.isfile(data.output_filename):
     print('Ouput file already exists:',data.output_filename)
     print('Exiting')
@@ -53,12 +97,47 @@ if not flow2supera.config.get_config(data.config):
     print('Invalid configuration option argument:',data.config)
     sys.exit(3)
 
-flow2supera.utils.run_supera(out_file=data.output_filename,
-    in_file=args[0],
+selection = dict()
+if data.event_ids:
+    if os.path.isfile(data.event_ids):
+        with open(data.event_ids, 'r') as f:
+            selection['event_ids'] = [int(line) for line in f if line.strip()]
+    else:
+        selection['event_ids'] = [int(event_id) for event_id in data.event_ids.split(',')]
+if int(data.min_hits) > 0:
+    selection['min_hits'] = int(data.min_hits)
+
+job = dict(out_file=data.output_filename,
+    in_file=args,
     config_key=data.config,
     num_events=int(data.num_events),
     num_flash_events=int(data.num_flash_events),
     num_skip=int(data.skip),
     num_flash_skip=int(data.num_flash_skip),
     save_log=data.log_file,
+    cache_truth=data.cache_truth,
+    workers=int(data.workers),
+    batches_per_worker=int(data.batches_per_worker),
+    prefetch=int(data.prefetch),
+    truth_index=data.truth_index or bool(data.truth_index_dir),
+    truth_index_dir=data.truth_index_dir,
+    column_store_dir=data.column_store_dir,
+    block_cache_size=int(float(data.block_cache_mb) * (1<<20)),
+    rdcc_nbytes=int(float(data.rdcc_mb) * (1<<20)) or None,
+    rdcc_nslots=int(data.rdcc_nslots) or None,
+    read_all_fields=data.read_all_fields,
+    read_flashes=data.read_flashes,
+    flash_match=data.flash_match,
+    flash_window=tuple(float(value) for value in data.flash_window.split(',')),
+    flash_time_scale=float(data.flash_time_scale),
+    output_format=data.output_format,
+    checkpoint_interval=int(data.checkpoint_interval),
+    profile_file=data.profile_file,
+    selection=selection,
     )
+
+if data.server:
+    seconds = flow2supera.server.submit_job(data.server, **job)
+    print('Job done by the server in %.2f seconds' % seconds)
+else:
+    flow2supera.utils.run_supera(**job)
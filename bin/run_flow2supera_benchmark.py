@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+import flow2supera.benchmark
+import sys,os
+
+from optparse import OptionParser
+
+parser = OptionParser(usage='Generate a synthetic ndlar_flow file and time the conversion stages on it.')
+parser.add_option("-o", "--output", dest="output_filename", metavar="FILE", default='benchmark.json',
+                  help="JSON file to save the results to")
+parser.add_option("-d", "--work_dir", dest="work_dir", metavar="DIR", default='.',
+                  help="directory for the synthetic input and the temporary output")
+parser.add_option("-c", "--config", dest="config", metavar='FILE/KEYWORD', default='2x2',
+                  help="Configuration keyword or a file path used by the driver stages")
+parser.add_option("--stages", dest="stages", metavar="LIST", default=','.join(flow2supera.benchmark.STAGES),
+                  help="comma separated stages to time: %s" % ','.join(flow2supera.benchmark.STAGES))
+parser.add_option("-n", "--num_events", dest="num_events", metavar="INT", default=10,
+                  help="number of synthetic events")
+parser.add_option("--hits", dest="hits_per_event", metavar="INT", default=1000,
+                  help="number of hits per event")
+parser.add_option("--contributors", dest="contributors", metavar="INT", default=100,
+                  help="width of the backtrack fraction/segment_id arrays")
+parser.add_option("--contributors_per_hit", dest="contributors_per_hit", metavar="INT", default=3,
+                  help="number of non-zero backtrack contributors per hit")
+parser.add_option("--segments", dest="segments_per_event", metavar="INT", default=200,
+                  help="number of segments per event")
+parser.add_option("--trajectories", dest="trajectories_per_event", metavar="INT", default=20,
+                  help="number of trajectories with segments per event")
+parser.add_option("--trajectory_stride", dest="trajectory_stride", metavar="INT", default=20,
+                  help="trajectory ID range per event (>= --trajectories); larger values spread the IDs")
+parser.add_option("--flashes", dest="flashes_per_event", metavar="INT", default=0,
+                  help="number of light flashes per event (0 writes no light data)")
+parser.add_option("--seed", dest="seed", metavar="INT", default=0,
+                  help="random seed of the synthetic file")
+
+(data, args) = parser.parse_args()
+
+flow2supera.log.setup_logging()
+
+if os.path.isfile(data.output_filename):
+    print('Ouput file already exists:',data.output_filename)
+    print('Exiting')
+    sys.exit(1)
+
+if int(data.trajectory_stride) < int(data.trajectories_per_event):
+    print('--trajectory_stride must be at least --trajectories')
+    print('Exiting')
+    sys.exit(2)
+
+file_options = dict(num_events=int(data.num_events),
+                    hits_per_event=int(data.hits_per_event),
+                    contributors=int(data.contributors),
+                    contributors_per_hit=int(data.contributors_per_hit),
+                    segments_per_event=int(data.segments_per_event),
+                    trajectories_per_event=int(data.trajectories_per_event),
+                    trajectory_stride=int(data.trajectory_stride),
+                    flashes_per_event=int(data.flashes_per_event),
+                    seed=int(data.seed))
+
+flow2supera.benchmark.run_benchmark(data.output_filename, data.work_dir,
+                                    config_key=data.config,
+                                    stages=data.stages.split(','),
+                                    file_options=file_options)
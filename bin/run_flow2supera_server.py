@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+import flow2supera.server
+import sys,os
+
+from optparse import OptionParser
+
+parser = OptionParser(usage='Keep configured drivers warm and run the conversion jobs sent by run_flow2supera.py --server.')
+parser.add_option("-a", "--address", dest="address", metavar="ADDRESS", default=flow2supera.server.DEFAULT_ADDRESS,
+                  help="unix socket path or host:port to listen on")
+parser.add_option("-c", "--config", dest="config", metavar='LIST', default='',
+                  help="comma separated configuration keywords or file paths to configure before the first job")
+parser.add_option("--stop", dest="stop", action="store_true", default=False,
+                  help="stop the server listening at --address after its current job")
+
+(data, args) = parser.parse_args()
+
+flow2supera.log.setup_logging()
+
+if data.stop:
+    flow2supera.server.stop_server(data.address)
+    sys.exit(0)
+
+config_keys = [os.path.abspath(key) if os.path.isfile(key) else key
+               for key in data.config.split(',') if key]
+server = flow2supera.server.ConversionServer(data.address, config_keys=config_keys)
+server.Serve()
@@ -19,7 +19,8 @@ setup(
         'Source Code': 'https://github.com/andrewmogan/flow2supera'
     },
     url='https://github.com/andrewmogan/flow2supera',
-    scripts=['bin/run_flow2supera.py'],
+    scripts=['bin/run_flow2supera.py','bin/run_flow2supera_benchmark.py',
+             'bin/run_flow2supera_server.py'],
     packages=['flow2supera','flow2supera.pdg_data','flow2supera.config_data'],
     package_dir={'': 'src'},
     package_data={'flow2supera': ['pdg_data/pdg.npz','config_data/*.yaml']},
@@ -1,3 +1,11 @@
-import edep2supera
-#import utils,config
-from . import utils, config, driver, reader, pdg2mass
\ No newline at end of file
+import importlib
+from . import log, config, profiler
+
+# ROOT, edep2supera, larcv and LarpixParser are only loaded when a module that
+# needs them is first used, so that "import flow2supera" (and the job client) starts fast
+_LAZY_MODULES = ('utils', 'driver', 'reader', 'pdg2mass', 'benchmark', 'server')
+
+def __getattr__(name):
+    if name in _LAZY_MODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
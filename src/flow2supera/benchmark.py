@@ -0,0 +1,290 @@
+import json
+import os
+import subprocess
+import time
+import h5py
+import numpy as np
+import flow2supera
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+# Geant4 process codes (TG4TrajectoryPoint) used for the synthetic secondaries
+G4_PROCESS_ELECTROMAGNETIC = 2
+G4_SUBTYPE_EM_IONIZATION = 2
+
+MUON_PDG = 13
+ELECTRON_PDG = 11
+
+STAGES = ('get_event', 'truth', 'read_event', 'run_supera')
+
+
+def make_synthetic_flow_file(file_name,
+                             num_events=10,
+                             hits_per_event=1000,
+                             contributors=100,
+                             contributors_per_hit=3,
+                             segments_per_event=200,
+                             trajectories_per_event=20,
+                             trajectory_stride=20,
+                             flashes_per_event=0,
+                             sipm_hits_per_flash=16,
+                             seed=0):
+    '''
+    Write an ndlar_flow-layout file with the datasets FlowReader reads.
+
+    Each event owns a block of trajectory_stride trajectory rows, the first
+    trajectories_per_event of which leave segments: one primary muon and
+    delta electrons whose parent is the muon. A stride larger than the number
+    of trajectories spreads the trajectory IDs of the file over a wider range.
+    Every hit has contributors backtrack slots, contributors_per_hit of which
+    are non-zero. With flashes_per_event > 0, light events with SiPM hits are
+    written and referenced from the charge events, with times near ts_start.
+    '''
+    rng = np.random.default_rng(seed)
+    num_hits = num_events * hits_per_event
+    num_segments = num_events * segments_per_event
+    num_trajectories = num_events * trajectory_stride
+    event_ids = np.arange(num_events)
+
+    events = np.zeros(num_events, dtype=[('id', 'u4'), ('ts_start', 'f8'), ('ts_end', 'f8'), ('nhit', 'u4')])
+    events['id'] = event_ids
+    events['ts_start'] = event_ids * 1.2e6
+    events['ts_end'] = events['ts_start'] + 2000.
+    events['nhit'] = hits_per_event
+
+    hit_regions = np.zeros(num_events, dtype=[('start', 'i8'), ('stop', 'i8')])
+    hit_regions['start'] = event_ids * hits_per_event
+    hit_regions['stop'] = hit_regions['start'] + hits_per_event
+    hit_events = np.repeat(event_ids, hits_per_event)
+    hit_refs = np.stack([hit_events, np.arange(num_hits)], axis=-1)
+
+    hits = np.zeros(num_hits, dtype=[('id', 'u4'), ('x', 'f4'), ('y', 'f4'), ('z', 'f4'),
+                                     ('t_drift', 'f4'), ('ts_pps', 'u8'), ('Q', 'f4'), ('E', 'f4')])
+    hits['id'] = np.arange(num_hits)
+    hits['x'] = rng.uniform(-60., 60., num_hits)
+    hits['y'] = rng.uniform(-320., -210., num_hits)
+    hits['z'] = rng.uniform(1240., 1360., num_hits)
+    hits['t_drift'] = rng.uniform(0., 2000., num_hits)
+    hits['Q'] = rng.exponential(50., num_hits)
+    hits['E'] = hits['Q'] * 0.023
+
+    backtrack = np.zeros(num_hits, dtype=[('fraction', 'f4', (contributors,)),
+                                          ('segment_id', 'u8', (contributors,))])
+    num_nonzero = min(contributors_per_hit, contributors)
+    local_segments = rng.integers(0, segments_per_event, (num_hits, num_nonzero))
+    backtrack['segment_id'][:, :num_nonzero] = hit_events[:, None] * segments_per_event + local_segments
+    fractions = rng.uniform(0.1, 1., (num_hits, num_nonzero))
+    backtrack['fraction'][:, :num_nonzero] = fractions / fractions.sum(axis=1, keepdims=True)
+
+    segment_events = np.repeat(event_ids, segments_per_event)
+    segments = np.zeros(num_segments, dtype=[('segment_id', 'u8'), ('event_id', 'u4'), ('vertex_id', 'u8'),
+                                             ('traj_id', 'u8'), ('pdg_id', 'i4'), ('dE', 'f4'),
+                                             ('dEdx', 'f4'), ('x_start', 'f4'), ('y_start', 'f4'),
+                                             ('z_start', 'f4'), ('t0', 'f4')])
+    segments['segment_id'] = np.arange(num_segments)
+    segments['event_id'] = segment_events
+    segments['vertex_id'] = segment_events
+    segments['traj_id'] = (segment_events * trajectory_stride +
+                           rng.integers(0, trajectories_per_event, num_segments))
+    segments['dE'] = rng.exponential(0.5, num_segments)
+    segments['dEdx'] = rng.uniform(1.5, 3., num_segments)
+
+    trajectory_rows = np.arange(num_trajectories)
+    local_trajectory_ids = trajectory_rows % trajectory_stride
+    is_primary = local_trajectory_ids == 0
+    trajectories = np.zeros(num_trajectories, dtype=[('event_id', 'u4'), ('vertex_id', 'u8'),
+                                                     ('traj_id', 'u8'), ('local_traj_id', 'u8'),
+                                                     ('parent_id', 'i8'),
+                                                     ('E_start', 'f4'), ('pxyz_start', 'f4', (3,)),
+                                                     ('xyz_start', 'f4', (3,)), ('t_start', 'f4'),
+                                                     ('E_end', 'f4'), ('pxyz_end', 'f4', (3,)),
+                                                     ('xyz_end', 'f4', (3,)), ('t_end', 'f4'),
+                                                     ('pdg_id', 'i4'),
+                                                     ('start_process', 'u4'), ('start_subprocess', 'u4'),
+                                                     ('end_process', 'u4'), ('end_subprocess', 'u4')])
+    trajectories['event_id'] = trajectory_rows // trajectory_stride
+    trajectories['vertex_id'] = trajectories['event_id']
+    trajectories['traj_id'] = trajectory_rows
+    trajectories['local_traj_id'] = local_trajectory_ids
+    trajectories['parent_id'] = np.where(is_primary, -1, trajectory_rows - local_trajectory_ids)
+    trajectories['pdg_id'] = np.where(is_primary, MUON_PDG, ELECTRON_PDG)
+    trajectories['start_process'] = np.where(is_primary, 0, G4_PROCESS_ELECTROMAGNETIC)
+    trajectories['start_subprocess'] = np.where(is_primary, 0, G4_SUBTYPE_EM_IONIZATION)
+    trajectories['pxyz_start'] = rng.normal(0., 50., (num_trajectories, 3))
+    trajectories['E_start'] = np.linalg.norm(trajectories['pxyz_start'], axis=1)
+    trajectories['xyz_start'] = rng.uniform(-50., 50., (num_trajectories, 3))
+    trajectories['xyz_end'] = trajectories['xyz_start'] + rng.normal(0., 5., (num_trajectories, 3))
+    trajectories['t_end'] = trajectories['t_start'] + 1.
+
+    interactions = np.zeros(num_events, dtype=[('event_id', 'u4'), ('vertex_id', 'u8'),
+                                               ('vertex', 'f4', (4,))])
+    interactions['event_id'] = event_ids
+    interactions['vertex_id'] = event_ids
+
+    with h5py.File(file_name, 'w') as fout:
+        fout.create_dataset('charge/events/data', data=events)
+        fout.create_dataset('charge/events/ref/charge/calib_final_hits/ref', data=hit_refs)
+        fout.create_dataset('charge/events/ref/charge/calib_final_hits/ref_region', data=hit_regions)
+        fout.create_dataset('charge/calib_final_hits/data', data=hits, chunks=True, compression='gzip')
+        fout.create_dataset('mc_truth/calib_final_hit_backtrack/data', data=backtrack,
+                            chunks=True, compression='gzip')
+        fout.create_dataset('mc_truth/segments/data', data=segments, chunks=True, compression='gzip')
+        fout.create_dataset('mc_truth/trajectories/data', data=trajectories, chunks=True, compression='gzip')
+        fout.create_dataset('mc_truth/interactions/data', data=interactions)
+        if flashes_per_event > 0:
+            _write_light(fout, rng, events, flashes_per_event, sipm_hits_per_flash)
+
+
+def _write_light(fout, rng, events, flashes_per_event, sipm_hits_per_flash):
+    '''
+    Write light events and SiPM hits, each flash referenced by one charge event.
+    '''
+    num_events = len(events)
+    num_flashes = num_events * flashes_per_event
+    num_sipm_hits = num_flashes * sipm_hits_per_flash
+    flash_events = np.repeat(np.arange(num_events), flashes_per_event)
+
+    light_events = np.zeros(num_flashes, dtype=[('id', 'u4'), ('tai_ns', 'u8', (8,))])
+    light_events['id'] = np.arange(num_flashes)
+    light_events['tai_ns'] = (events['ts_start'][flash_events] + rng.uniform(0., 1000., num_flashes))[:, None]
+
+    sipm_hit_regions = np.zeros(num_flashes, dtype=[('start', 'i8'), ('stop', 'i8')])
+    sipm_hit_regions['start'] = np.arange(num_flashes) * sipm_hits_per_flash
+    sipm_hit_regions['stop'] = sipm_hit_regions['start'] + sipm_hits_per_flash
+
+    sipm_hits = np.zeros(num_sipm_hits, dtype=[('id', 'u4'), ('sum', 'f4'), ('busy_ns', 'f4')])
+    sipm_hits['id'] = np.arange(num_sipm_hits)
+    sipm_hits['sum'] = rng.exponential(100., num_sipm_hits)
+    sipm_hits['busy_ns'] = np.sort(rng.uniform(0., 500., (num_flashes, sipm_hits_per_flash)), axis=1).ravel()
+
+    light_regions = np.zeros(num_events, dtype=[('start', 'i8'), ('stop', 'i8')])
+    light_regions['start'] = np.arange(num_events) * flashes_per_event
+    light_regions['stop'] = light_regions['start'] + flashes_per_event
+    light_refs = np.stack([flash_events, np.arange(num_flashes)], axis=-1)
+
+    fout.create_dataset('light/events/data', data=light_events)
+    fout.create_dataset('light/events/ref/light/sipm_hits/ref_region', data=sipm_hit_regions)
+    fout.create_dataset('light/sipm_hits/data', data=sipm_hits, chunks=True, compression='gzip')
+    fout.create_dataset('charge/events/ref/light/events/ref', data=light_refs)
+    fout.create_dataset('charge/events/ref/light/events/ref_region', data=light_regions)
+
+
+def _summarize(durations):
+    durations = np.asarray(durations)
+    return dict(num=len(durations),
+                mean=float(durations.mean()) if len(durations) else 0.,
+                min=float(durations.min()) if len(durations) else 0.,
+                max=float(durations.max()) if len(durations) else 0.,
+                total=float(durations.sum()))
+
+
+def bench_get_event(file_name, reader_options={}):
+    '''
+    Time FlowReader.GetEvent for every event of the file.
+    '''
+    reader = flow2supera.reader.FlowReader(None, file_name, **reader_options)
+    reader.GetEvent(0)
+    durations = []
+    for entry in range(len(reader)):
+        start = time.perf_counter()
+        reader.GetEvent(entry)
+        durations.append(time.perf_counter() - start)
+    reader.CloseFile()
+    return _summarize(durations)
+
+
+def bench_truth(file_name):
+    '''
+    Time FlowReader.GetEventTruthFromHits for every event, hits already in memory.
+    '''
+    reader = flow2supera.reader.FlowReader(None, file_name)
+    durations = []
+    for entry in range(len(reader)):
+        input_data = reader.GetEvent(entry)
+        start = time.perf_counter()
+        reader.GetEventTruthFromHits(input_data.backtracked_hits,
+                                     reader._segments,
+                                     reader._trajectories)
+        durations.append(time.perf_counter() - start)
+    reader.CloseFile()
+    return _summarize(durations)
+
+
+def bench_read_event(file_name, config_key):
+    '''
+    Time SuperaDriver.ReadEvent for every event, inputs already in memory.
+    '''
+    driver = flow2supera.utils.get_flow2supera(config_key)
+    reader = flow2supera.reader.FlowReader(driver.parser_run_config(), file_name)
+    durations = []
+    for entry in range(len(reader)):
+        input_data = reader.GetEvent(entry)
+        start = time.perf_counter()
+        driver.ReadEvent(input_data)
+        durations.append(time.perf_counter() - start)
+    reader.CloseFile()
+    return _summarize(durations)
+
+
+def bench_run_supera(file_name, config_key, out_dir, run_options={}):
+    '''
+    Time a whole run_supera conversion of the file.
+    '''
+    out_file = os.path.join(out_dir, 'bench_output.root')
+    if os.path.isfile(out_file):
+        os.remove(out_file)
+    start = time.perf_counter()
+    flow2supera.utils.run_supera(out_file=out_file, in_file=file_name, config_key=config_key,
+                                 **run_options)
+    result = _summarize([time.perf_counter() - start])
+    result['num_events'] = flow2supera.reader.count_events(file_name)
+    os.remove(out_file)
+    return result
+
+
+def git_commit():
+    '''
+    Return the commit of the flow2supera checkout, or an empty string outside git.
+    '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return ''
+
+
+def run_benchmark(out_json, work_dir, config_key='2x2', stages=STAGES, file_options={}):
+    '''
+    Generate a synthetic file in work_dir, time the requested stages on it,
+    and save the results with the generation parameters and commit to out_json.
+    '''
+    os.makedirs(work_dir, exist_ok=True)
+    file_name = os.path.join(work_dir, 'bench_flow.h5')
+    make_synthetic_flow_file(file_name, **file_options)
+
+    results = dict()
+    for stage in stages:
+        logger.info('Benchmarking %s', stage)
+        if stage == 'get_event':
+            results[stage] = bench_get_event(file_name)
+        elif stage == 'truth':
+            results[stage] = bench_truth(file_name)
+        elif stage == 'read_event':
+            results[stage] = bench_read_event(file_name, config_key)
+        elif stage == 'run_supera':
+            results[stage] = bench_run_supera(file_name, config_key, work_dir)
+        else:
+            raise ValueError('Unknown benchmark stage %s (options: %s)' % (stage, STAGES))
+        logger.info('  mean {mean:.3e} s over {num} calls'.format(**results[stage]))
+
+    report = dict(commit=git_commit(),
+                  time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  file_options=file_options,
+                  config=config_key,
+                  results=results)
+    with open(out_json, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.remove(file_name)
+    return report
@@ -1,30 +1,141 @@
 import os
 import glob
+import hashlib
+import pickle
+import importlib.util
+import yaml
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+# libyaml's loader when PyYAML was built with it, the pure-Python one otherwise
+Loader = getattr(yaml, 'CLoader', yaml.Loader)
+
+# Directory of the binary cache of resolved detector properties; an empty
+# FLOW2SUPERA_CACHE_DIR disables the on-disk cache
+CACHE_DIR_ENV = 'FLOW2SUPERA_CACHE_DIR'
+
+_configs = None
+_memory_cache = {}
 
 def get_config_dir():
 
     return os.path.join(os.path.dirname(__file__),'config_data')
 
-def list_config(full_path=False):
+def _config_files():
+
+    global _configs
+    if _configs is None:
+        fs = sorted(glob.glob(os.path.join(get_config_dir(), '*.yaml')))
+        _configs = {os.path.basename(f)[:-5]: f for f in fs}
+    return _configs
 
-    fs = glob.glob(os.path.join(get_config_dir(), '*.yaml'))
+def list_config(full_path=False):
 
     if full_path:
-        return fs
+        return list(_config_files().values())
 
-    return [os.path.basename(f)[:-5] for f in fs]
+    return list(_config_files())
 
 def get_config(name):
 
-    options = list_config()
-    results = list_config(True)
+    configs = _config_files()
+
+    if name in configs:
+        return configs[name]
+
+    if name.endswith('.yaml') and name[:-5] in configs:
+        return configs[name[:-5]]
+
+    logger.error('No data found for config name: %s', name)
+    raise NotImplementedError
+
+def load_yaml(txt):
+    '''
+    Parse a YAML configuration text. The result of each text is kept for the
+    life of the process, and a fresh copy is returned on every call.
+    '''
+    key = hashlib.sha1(txt.encode()).hexdigest()
+    if not key in _memory_cache:
+        _memory_cache[key] = pickle.dumps(yaml.load(txt, Loader=Loader), pickle.HIGHEST_PROTOCOL)
+    return pickle.loads(_memory_cache[key])
+
+def get_cache_dir():
+    '''
+    Return the directory of the on-disk cache, or None if it is disabled.
+    '''
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if cache_dir is None:
+        cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+        cache_dir = os.path.join(cache_home, 'flow2supera')
+    return cache_dir or None
 
-    if name in options:
-        return results[options.index(name)]
+def property_cache_key(cfg_dict):
+    '''
+    Content hash of everything the detector properties of a configuration are
+    resolved from: the property entries, the content of the TileLayout and
+    DetectorProperties files, and the path, size and modification time of
+    every file of the installed LarpixParser (which holds the code and the
+    geometry files of a PropertyKeyword), so in-place edits of an editable
+    install are noticed.
+    '''
+    digest = hashlib.sha1()
+    for keyword in ['PropertyKeyword','TileLayout','DetectorProperties']:
+        value = cfg_dict.get(keyword, None)
+        digest.update(repr(value).encode())
+        if value and os.path.isfile(str(value)):
+            with open(value, 'rb') as f:
+                digest.update(f.read())
+    spec = importlib.util.find_spec('LarpixParser')
+    if spec is not None and spec.origin:
+        package_dir = os.path.dirname(spec.origin)
+        digest.update(package_dir.encode())
+        for directory, subdirectories, files in os.walk(package_dir):
+            subdirectories.sort()
+            if os.path.basename(directory) == '__pycache__':
+                continue
+            for name in sorted(files):
+                stat = os.stat(os.path.join(directory, name))
+                digest.update(('%s:%d:%d' % (os.path.join(directory, name), stat.st_size,
+                                             stat.st_mtime_ns)).encode())
+    return digest.hexdigest()
 
-    alt_name = name + '.yaml'
-    if alt_name in options:
-        return results[options.index(alt_name)]
+def load_cached(key):
+    '''
+    Return the object cached under key (in this process or on disk), or None.
+    '''
+    data = _memory_cache.get(key)
+    cache_dir = get_cache_dir()
+    if data is None and cache_dir:
+        path = os.path.join(cache_dir, key + '.pkl')
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            _memory_cache[key] = data
+    if data is None:
+        return None
+    return pickle.loads(data)
 
-    print('No data found for config name:',name)
-    raise NotImplementedError
\ No newline at end of file
+def save_cached(key, value):
+    '''
+    Cache value under key in this process and, if enabled, on disk.
+    '''
+    try:
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError) as error:
+        logger.warning('Could not cache the detector properties: %s', error)
+        return
+    _memory_cache[key] = data
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return
+    path = os.path.join(cache_dir, key + '.pkl')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Processes starting together may write the same entry
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError as error:
+        logger.warning('Could not write the configuration cache %s: %s', path, error)
@@ -1,12 +1,83 @@
-import time
 import edep2supera, ROOT
 from ROOT import supera, std, TG4TrajectoryPoint
+import logging
 import numpy as np
-import LarpixParser
-from LarpixParser import hit_parser as HitParser
-import yaml
-from yaml import Loader
 import flow2supera
+from .config import load_yaml, property_cache_key, load_cached, save_cached
+from .profiler import NULL_PROFILER
+from .log import get_logger, set_log_level, WarningCounter
+
+logger = get_logger(__name__)
+
+# Compiled once per process: moves a whole event's worth of EDep columns into
+# the particle pclouds with a single Python->C++ crossing.
+_EDEP_FILLER_CODE = '''
+#ifndef FLOW2SUPERA_EDEP_FILLER
+#define FLOW2SUPERA_EDEP_FILLER
+namespace flow2supera {
+void FillEDeps(supera::EventInput& event, const size_t num_groups,
+               const size_t* group_index, const size_t* group_start,
+               const size_t* group_count,
+               const double* x, const double* y, const double* z,
+               const double* t, const double* e, const double* dedx)
+{
+    for (size_t group = 0; group < num_groups; ++group) {
+        auto& pcloud = event[group_index[group]].pcloud;
+        pcloud.reserve(pcloud.size() + group_count[group]);
+        const size_t stop = group_start[group] + group_count[group];
+        for (size_t i = group_start[group]; i < stop; ++i) {
+            supera::EDep edep;
+            edep.x = x[i];
+            edep.y = y[i];
+            edep.z = z[i];
+            edep.t = t[i];
+            edep.e = e[i];
+            edep.dedx = dedx[i];
+            pcloud.push_back(edep);
+        }
+    }
+}
+}
+#endif
+'''
+ROOT.gInterpreter.Declare(_EDEP_FILLER_CODE)
+
+class TrajectoryIndexMap:
+    '''
+    Maps trajectory IDs to their index in a supera::EventInput.
+    trajectory IDs are file-global after flow merging, so instead of a table
+    indexed by ID this keeps the event's IDs sorted and looks them up with
+    searchsorted. Memory scales with the number of trajectories in the event.
+    '''
+
+    def __init__(self):
+        self._sorted_ids = np.empty(0, dtype=np.int64)
+        self._indices = np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self._sorted_ids)
+
+    def Fill(self, trajectory_ids):
+        '''
+        Map trajectory_ids[i] to index i. A repeated ID maps to its last index.
+        '''
+        trajectory_ids = np.asarray(trajectory_ids, dtype=np.int64)
+        order = np.argsort(trajectory_ids, kind='stable')
+        self._sorted_ids = trajectory_ids[order]
+        self._indices = order.astype(np.uint64)
+
+    def Find(self, trajectory_ids):
+        '''
+        Return the index of each trajectory ID, or supera.kINVALID_INDEX if unknown.
+        Accepts a scalar or an array of IDs.
+        '''
+        query = np.asarray(trajectory_ids, dtype=np.int64)
+        if len(self._sorted_ids) == 0:
+            return np.full(query.shape, supera.kINVALID_INDEX, dtype=np.uint64)
+        positions = np.searchsorted(self._sorted_ids, query, side='right') - 1
+        positions = np.maximum(positions, 0)
+        found = self._sorted_ids[positions] == query
+        return np.where(found, self._indices[positions], np.uint64(supera.kINVALID_INDEX))
 
 class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
 
@@ -19,11 +90,20 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
         'fraction_nan',
         'ass_frac')
 
+    # Details attached to the process type warnings of ParticleTable
+    PROCESS_WARNING = ('PDG %d TrackId %d Kinetic Energy %g Parent PDG %d Parent TrackId %d '
+                       'G4ProcessType %d SubProcessType %d')
+
+    # Supera particle types assigned by ParticleTable, indexed by its type codes
+    PARTICLE_TYPES = ['kNeutron', 'kPrimary', 'kPhoton', 'kPhotoElectron', 'kCompton',
+                      'kConversion', 'kIonization', 'kDelta', 'kDecay', 'kOtherShower', 'kTrack']
+
     def __init__(self):
         super().__init__()
+        self._particle_types = [getattr(supera, name) for name in self.PARTICLE_TYPES]
         self._geom_dict  = None
         self._run_config = None
-        self._trajectory_id_to_index = std.vector('supera::Index_t')()
+        self._trajectory_id_to_index = TrajectoryIndexMap()
         self._allowed_detectors = std.vector('std::string')()
         self._edeps_unassociated = std.vector('supera::EDep')()
         self._edeps_all = std.vector('supera::EDep')()
@@ -33,7 +113,10 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
         self._electron_energy_threshold = 0
         self._estimate_pt_time = True
         self._ignore_bad_association = True
-        print("Initialized SuperaDriver class")
+        self._batch_edeps = True
+        self.profiler = NULL_PROFILER
+        self.warnings = WarningCounter(logger)
+        logger.debug('Initialized SuperaDriver class')
 
     def parser_run_config(self):
         return self._run_config
@@ -48,51 +131,63 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
 
     def LoadPropertyConfigs(self, cfg_dict):
 
+        # Resolved properties are cached by content, so LarpixParser is only
+        # imported and its geometry files only parsed on a cache miss
+        cache_key = property_cache_key(cfg_dict)
+        cached = load_cached(cache_key)
+        if cached is not None:
+            self._run_config, self._geom_dict = cached
+        elif not self._ResolvePropertyConfigs(cfg_dict):
+            return False
+        else:
+            save_cached(cache_key, (self._run_config, self._geom_dict))
+
+        logger.debug('Geometry: %s', self._geom_dict)
+        logger.debug('Run config: %s', self._run_config)
+        # Apply run config modification if requested
+        run_config_mod = cfg_dict.get('ParserRunConfig',None)
+        if run_config_mod:
+            for key,val in run_config_mod.items():
+                self._run_config[key]=val
+        return True
+
+    def _ResolvePropertyConfigs(self, cfg_dict):
+        import LarpixParser
+
         # Expect only PropertyKeyword or (TileLayout,DetectorProperties). Not both.
         if cfg_dict.get('PropertyKeyword',None):
             if cfg_dict.get('TileLayout',None) or cfg_dict.get('DetectorProperties',None):
-                print('PropertyKeyword provided:', cfg_dict['PropertyKeyword'])
-                print('But also founnd below:')
+                logger.error('PropertyKeyword provided: %s', cfg_dict['PropertyKeyword'])
+                logger.error('But also found below:')
                 for keyword in ['TileLayout','DetectorProperties']:
-                    print('%s: "%s"' % (keyword,cfg_dict.get(keyword, None)))
-                    print('Bool', bool(cfg_dict.get(keyword,None)))
-                print('You cannot specify duplicated property information!')
+                    logger.error('%s: "%s"', keyword, cfg_dict.get(keyword, None))
+                logger.error('You cannot specify duplicated property information!')
                 return False
             else:
-                print('else')
                 try:
-                    print('try')
                     self._run_config, self._geom_dict = LarpixParser.util.detector_configuration(cfg_dict['PropertyKeyword'])
                 except ValueError:
-                    print('Failed to load with PropertyKeyword', cfg_dict['PropertyKeyword'])
-                    print('Supported types:', LarpixParser.util.configuration_keywords())
+                    logger.error('Failed to load with PropertyKeyword %s', cfg_dict['PropertyKeyword'])
+                    logger.error('Supported types: %s', LarpixParser.util.configuration_keywords())
                     return False
         else:
-            print('PropertyKeyword missing. Loading TileLayout and DetectorProperties...')
+            logger.info('PropertyKeyword missing. Loading TileLayout and DetectorProperties...')
             if not 'TileLayout' in cfg_dict:
-                print('TileLayout not in the configuration data!')
+                logger.error('TileLayout not in the configuration data!')
                 return False
 
             if not 'DetectorProperties' in cfg_dict:
-                print('DetectorProperties not in the configuration data!')
+                logger.error('DetectorProperties not in the configuration data!')
                 raise False
 
             self._geom_dict  = LarpixParser.util.load_geom_dict(cfg_dict['TileLayout'])
             self._run_config = LarpixParser.util.get_run_config(cfg_dict['DetectorProperties'])
-
-        print('self._geom_dict', self._geom_dict)
-        print('self._run_config', self._run_config)
-        # Apply run config modification if requested
-        run_config_mod = cfg_dict.get('ParserRunConfig',None)
-        if run_config_mod:
-            for key,val in run_config_mod.items():
-                self._run_config[key]=val
-        print('Returning property configs')
         return True
 
     def ConfigureFromFile(self,fname):
         with open(fname,'r') as f:
-            cfg=yaml.load(f.read(),Loader=Loader)
+            cfg=load_yaml(f.read())
+            set_log_level(cfg.get('LogLevel', 'INFO'))
             self._electron_energy_threshold = cfg.get('ElectronEnergyThreshold',
                 self._electron_energy_threshold
                 )
@@ -102,11 +197,13 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
                 self._ass_distance_limit)
             self._ass_charge_limit = cfg.get('AssChargeLimit',
                 self._ass_charge_limit)
+            self._batch_edeps = cfg.get('BatchEDeps',
+                self._batch_edeps)
 
         super().ConfigureFromFile(fname)
 
     def ConfigureFromText(self,txt):
-        cfg=yaml.load(txt, Loader=Loader)
+        cfg=load_yaml(txt)
         if not self.LoadPropertyConfigs(cfg):
             raise ValueError('Failed to configure flow2supera!')
             self._electron_energy_threshold = cfg.get('ElectronEnergyThreshold',
@@ -115,73 +212,252 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
         super().ConfigureFromText(txt)
 
     def ReadEvent(self, data, verbose=False):
-        
-        start_time = time.time()
-
-        # Assuming your segment IDs are in a dataset named 'segment_ids'
-        segment_ids = data.segments['segment_id']  # Load the segment IDs into a NumPy array
-        segment_id_to_index = {segment_id: index for index, segment_id in enumerate(segment_ids)}
 
         supera_event = supera.EventInput()
         supera_event.reserve(len(data.trajectories))
 
         trajectory_ids = data.trajectories['traj_id']
-        unique_trajectory_ids = set(trajectory_ids)
-        print('Num unique trajectory IDs:', len(unique_trajectory_ids))
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug('Num unique trajectory IDs: %d', len(np.unique(trajectory_ids)))
+        self.profiler.Count('trajectories', len(trajectory_ids))
 
         # 1. Loop over trajectories, create one supera::ParticleInput for each
         #    store particle inputs in list to fill parent information later
-        #max_trajectory_id = max(data.trajectories['traj_id'].max(), data.segments['traj_id'].max())
-
-        #Note: local_traj_id is not unique for the file due to merging of flow files, so use 'local_traj_id'
-        #max_trajectory_id = data.trajectories['traj_id'].max()
-        max_trajectory_id = data.trajectories['traj_id'].max()
-        max_segment_id = data.segments['traj_id'].max()
-        if verbose: print('Max trajectory ID:', max_trajectory_id)
-
-        # When we start constructing Supera::EDeps, we'll need a map from the local 
-        # trajectory ID to the index within supera_event in order to correctly associate
-        # EDeps to the right pcloud. 
-        # TODO This will get enormous for large trajectory IDs. How should we handle this?
-        self._trajectory_id_to_index.resize(int(max_trajectory_id + 1), supera.kINVALID_INDEX)
-        for traj in data.trajectories:
-            part_input = supera.ParticleInput()
-
-            part_input.valid = True
-            part_input.part  = self.TrajectoryToParticle(traj)
-            part_input.part.id = supera_event.size()
-            if self.GetLogger().verbose():
-                if verbose:
-                    print('TrackID',part_input.part.trackid,
-                          'PDG',part_input.part.pdg,
-                          'Energy',part_input.part.energy_init)
-            if traj['traj_id'] < 0:
-                print('Negative track ID found',traj['traj_id'])
-                raise ValueError
-            self._trajectory_id_to_index[int(traj['traj_id'])] = part_input.part.id
-            supera_event.push_back(part_input)
-
-        print('Trajectory ID to Index map len:', len(self._trajectory_id_to_index))
-            
-        if verbose:
-            print("--- trajectory filling %s seconds ---" % (time.time() - start_time)) 
-        start_time = time.time()  
+        #Note: local_traj_id is not unique for the file due to merging of flow files, so use 'traj_id'
+
+        if np.any(trajectory_ids < 0):
+            logger.error('Negative track ID found %d', trajectory_ids[trajectory_ids < 0][0])
+            raise ValueError
+
+        with self.profiler.Timer('particles'):
+            for traj in data.trajectories:
+                part_input = supera.ParticleInput()
+
+                part_input.valid = True
+                part_input.part  = self.TrajectoryToParticle(traj)
+                part_input.part.id = supera_event.size()
+                if debug and verbose:
+                    logger.debug('TrackID %d PDG %d Energy %g',
+                                 part_input.part.trackid,
+                                 part_input.part.pdg,
+                                 part_input.part.energy_init)
+                supera_event.push_back(part_input)
+
+            # When we start constructing Supera::EDeps, we'll need a map from the
+            # trajectory ID to the index within supera_event in order to correctly associate
+            # EDeps to the right pcloud. 
+            self._trajectory_id_to_index.Fill(trajectory_ids)
+
+        if debug:
+            logger.debug('Trajectory ID to Index map len: %d', len(self._trajectory_id_to_index))
 
         # 2. Fill parent information for ParticleInputs created in previous loop
-        print('Len supera_event:', len(supera_event))
-        for i, part in enumerate(supera_event):
-            traj = data.trajectories[i]
-            parent = None            
-            if (part.part.parent_trackid >= self._trajectory_id_to_index.size()): continue
-            parent_index = self._trajectory_id_to_index[part.part.parent_trackid]
-            if parent_index == supera.kINVALID_INDEX: #TO DO: Check this
-                print('Skipping invalid index')
-                continue
-
-            parent = supera_event[parent_index].part
-            part.part.parent_pdg = parent.pdg
-                    
-            self.SetProcessType(traj, part.part, parent)
+        if debug:
+            logger.debug('Len supera_event: %d', len(supera_event))
+        with self.profiler.Timer('parents'):
+            table = self.ParticleTable(data.trajectories)
+            has_parent = table['has_parent'].tolist()
+            parent_pdg = table['parent_pdg'].tolist()
+            ancestor_trackid = table['ancestor_trackid'].tolist()
+            ancestor_pdg = table['ancestor_pdg'].tolist()
+            process = table['process']
+            particle_types = [self._particle_types[code] if code >= 0 else None
+                              for code in table['type'].tolist()]
+            for i, part in enumerate(supera_event):
+                p = part.part
+                p.ancestor_trackid = ancestor_trackid[i]
+                p.ancestor_pdg = ancestor_pdg[i]
+                #TO DO: Check this
+                if not has_parent[i]:
+                    continue
+                p.parent_pdg = parent_pdg[i]
+                p.process = process[i]
+                p.type = particle_types[i]
+
+        # 3. Attach one EDep per (hit, contributor) pair to its particle
+        with self.profiler.Timer('edeps'):
+            if self._batch_edeps:
+                self.FillEDepsBatched(data, supera_event)
+            else:
+                self.FillEDepsLoop(data, supera_event)
+
+        return supera_event
+
+    def ParticleTable(self, trajectories):
+        '''
+        Resolve the parent, ancestor and Supera type of every trajectory of the
+        event as NumPy columns, following the edep-sim process types. Requires
+        the trajectory ID to index map to be filled. Particles whose parent is
+        not in the event get no parent PDG, process or type (type -1); their
+        ancestor is the topmost particle of their chain found in the event.
+        '''
+        trackid = trajectories['traj_id'].astype(np.int64)
+        parent_id = trajectories['parent_id'].astype(np.int64)
+        # Trajectory ID of -1 corresponds to a primary particle
+        parent_trackid = np.where(parent_id == -1, trackid, parent_id)
+        pdg = trajectories['pdg_id'].astype(np.int64)
+        rows = np.arange(len(trackid))
+
+        parent_index = self._trajectory_id_to_index.Find(parent_trackid)
+        has_parent = parent_index != np.uint64(supera.kINVALID_INDEX)
+        parent_row = np.where(has_parent, parent_index, rows).astype(np.int64)
+        parent_pdg = pdg[parent_row]
+
+        # Pointer jumping: each pass doubles the distance followed up the chain
+        ancestor_row = parent_row
+        for _ in range(len(rows).bit_length() + 1):
+            next_row = ancestor_row[ancestor_row]
+            if np.array_equal(next_row, ancestor_row):
+                break
+            ancestor_row = next_row
+
+        g4type_main = trajectories['start_process'].astype(np.int64)
+        g4type_sub  = trajectories['start_subprocess'].astype(np.int64)
+        process = ['%d::%d' % pair for pair in zip(g4type_main.tolist(), g4type_sub.tolist())]
+
+        momentum = trajectories['pxyz_start'].astype(np.float64)
+        ke = np.sqrt((momentum**2).sum(axis=1))
+        # Signed sum of the offsets between the parent's end and the particle's start
+        dr = (trajectories['xyz_end'][parent_row].astype(np.float64) -
+              trajectories['xyz_start'].astype(np.float64)).sum(axis=1)
+        below_threshold = ke < self._electron_energy_threshold
+
+        abs_parent_pdg = np.abs(parent_pdg)
+        is_neutron = (pdg == 2112) | (pdg > 1000000000)
+        is_primary = trackid == parent_trackid
+        is_electron = np.abs(pdg) == 11
+        is_em = g4type_main == int(TG4TrajectoryPoint.G4ProcessType.kProcessElectromagetic)
+        is_ionization = g4type_sub == int(TG4TrajectoryPoint.G4ProcessSubtype.kSubtypeEMIonization)
+        is_hadronic_151 = ((g4type_main == int(TG4TrajectoryPoint.G4ProcessType.kProcessHadronic)) &
+                           (g4type_sub == 151) & (dr < 0.0001))
+        known_ionization_parent = ((abs_parent_pdg == 11) | np.isin(abs_parent_pdg, [211,13,2212,321]) |
+                                   (parent_pdg == 22))
+        em_subtypes = [int(TG4TrajectoryPoint.G4ProcessSubtype.kSubtypeEMPhotoelectric),
+                       int(TG4TrajectoryPoint.G4ProcessSubtype.kSubtypeEMComptonScattering),
+                       int(TG4TrajectoryPoint.G4ProcessSubtype.kSubtypeEMGammaConversion),
+                       int(TG4TrajectoryPoint.G4ProcessSubtype.kSubtypeEMPairProdByCharged),
+                       int(TG4TrajectoryPoint.G4ProcessSubtype.kSubtypeEMIonization)]
+
+        electron = has_parent & ~is_neutron & ~is_primary & (pdg != 22) & is_electron
+        em_electron = electron & is_em
+        unexpected_subtype = em_electron & ~np.isin(g4type_sub, em_subtypes)
+        if np.any(unexpected_subtype):
+            i = np.nonzero(unexpected_subtype)[0][0]
+            logger.error('Unexpected EM subtype: ' + self.PROCESS_WARNING,
+                         pdg[i], trackid[i], ke[i], parent_pdg[i], parent_trackid[i],
+                         g4type_main[i], g4type_sub[i])
+            raise ValueError
+
+        unexpected_ionization = em_electron & is_ionization & ~known_ionization_parent
+        guessed_shower = electron & ~is_em & \
+            (g4type_main != int(TG4TrajectoryPoint.G4ProcessType.kProcessDecay)) & ~is_hadronic_151
+        for i in np.nonzero(unexpected_ionization)[0]:
+            self.warnings.Warn('unexpected case for ionization', self.PROCESS_WARNING,
+                               pdg[i], trackid[i], ke[i], parent_pdg[i], parent_trackid[i],
+                               g4type_main[i], g4type_sub[i])
+        for i in np.nonzero(guessed_shower)[0]:
+            self.warnings.Warn('guessing the shower type as Compton' if below_threshold[i]
+                               else 'guessing the shower type as OtherShower',
+                               self.PROCESS_WARNING,
+                               pdg[i], trackid[i], ke[i], parent_pdg[i], parent_trackid[i],
+                               g4type_main[i], g4type_sub[i])
+
+        def code(name):
+            return self.PARTICLE_TYPES.index(name)
+
+        em_type = np.select(
+            [g4type_sub == em_subtypes[0],
+             g4type_sub == em_subtypes[1],
+             (g4type_sub == em_subtypes[2]) | (g4type_sub == em_subtypes[3]),
+             abs_parent_pdg == 11,
+             np.isin(abs_parent_pdg, [211,13,2212,321]),
+             parent_pdg == 22],
+            [code('kPhotoElectron'), code('kCompton'), code('kConversion'),
+             code('kIonization'), code('kDelta'), code('kCompton')],
+            code('kIonization'))
+        electron_type = np.select(
+            [is_em,
+             g4type_main == int(TG4TrajectoryPoint.G4ProcessType.kProcessDecay),
+             is_hadronic_151],
+            [em_type,
+             code('kDecay'),
+             np.where(below_threshold, code('kIonization'), code('kDecay'))],
+            np.where(below_threshold, code('kCompton'), code('kOtherShower')))
+        particle_type = np.select(
+            [~has_parent, is_neutron, is_primary, pdg == 22, is_electron],
+            [-1, code('kNeutron'), code('kPrimary'), code('kPhoton'), electron_type],
+            code('kTrack'))
+
+        return dict(parent_index=parent_index,
+                    has_parent=has_parent,
+                    parent_pdg=parent_pdg,
+                    ancestor_trackid=trackid[ancestor_row],
+                    ancestor_pdg=pdg[ancestor_row],
+                    process=process,
+                    type=particle_type)
+
+    def FillEDepsBatched(self, data, supera_event):
+        '''
+        Build the EDeps of every non-zero (hit, contributor) pair as NumPy columns,
+        group them by target particle, and hand each group to its pcloud in bulk.
+        The EDep order within each pcloud matches FillEDepsLoop.
+        '''
+        backtracked_hits = data.backtracked_hits
+        fractions = backtracked_hits['fraction']
+        #from larnd2supera, 2023-09-14 YC: 
+        #I think frac_min should be allowed to be below 0 for the sake of induced current. 
+        #SK: So, only skipping 0 
+        contributor_mask = fractions != 0
+        hit_indices = np.nonzero(contributor_mask)[0]
+        segment_ids = backtracked_hits['segment_id'][contributor_mask]
+
+        segment_order = np.argsort(data.segments['segment_id'], kind='stable')
+        sorted_segment_ids = data.segments['segment_id'][segment_order]
+        segment_positions = np.searchsorted(sorted_segment_ids, segment_ids, side='right') - 1
+        segment_positions = np.maximum(segment_positions, 0)
+        if len(segment_ids) and not np.array_equal(sorted_segment_ids[segment_positions], segment_ids):
+            raise KeyError('Backtracked segment ID missing from the event segments')
+        segment_indices = segment_order[segment_positions]
+        segments = data.segments[segment_indices]
+
+        unique_trajectory_ids, trajectory_inverse = np.unique(segments['traj_id'],
+                                                              return_inverse=True)
+        unique_event_indices = self._trajectory_id_to_index.Find(unique_trajectory_ids)
+        if np.any(unique_event_indices == supera.kINVALID_INDEX):
+            raise ValueError('Invalid EventInput index')
+        event_indices = unique_event_indices[trajectory_inverse]
+
+        hits = data.hits[hit_indices]
+        energies = hits['E'] * fractions[contributor_mask]
+        self.profiler.Count('edeps', len(energies))
+
+        group_order = np.argsort(event_indices, kind='stable')
+        group_index, group_start, group_count = np.unique(event_indices[group_order],
+                                                          return_index=True,
+                                                          return_counts=True)
+
+        def column(values):
+            return np.ascontiguousarray(values[group_order], dtype=np.float64)
+
+        ROOT.flow2supera.FillEDeps(supera_event, len(group_index),
+                                   group_index.astype(np.uint64),
+                                   group_start.astype(np.uint64),
+                                   group_count.astype(np.uint64),
+                                   column(hits['x']),
+                                   column(hits['y']),
+                                   column(hits['z']),
+                                   column(hits['t_drift']),
+                                   column(energies),
+                                   column(segments['dEdx']))
+
+    def FillEDepsLoop(self, data, supera_event):
+        '''
+        Reference implementation of FillEDepsBatched that creates and pushes
+        one supera.EDep at a time.
+        '''
+        segment_ids = data.segments['segment_id']
+        segment_id_to_index = {segment_id: index for index, segment_id in enumerate(segment_ids)}
 
         max_contributors = 100
         hit_threshold = 0.0001
@@ -208,17 +484,11 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
                 trajectory_id = int(segment['traj_id'])
                 edep.dedx = segment['dEdx']
                 edep.e = reco_hit['E'] * backtracked_hit['fraction'][contrib]
-                supera_event_index = self._trajectory_id_to_index[trajectory_id]
+                supera_event_index = self._trajectory_id_to_index.Find(trajectory_id)
                 if supera_event_index == supera.kINVALID_INDEX:
                     raise ValueError('Invalid EventInput index')
-                supera_event[supera_event_index].pcloud.push_back(edep)
-
-        if verbose:
-            print('Driver processed hits in {:.2f} s'.format(time.time() - start_time))
-
-        start_time = time.time()
-
-        return supera_event
+                supera_event[int(supera_event_index)].pcloud.push_back(edep)
+                self.profiler.Count('edeps')
 
     def TrajectoryToParticle(self, trajectory):
         ### What we have access to in new flow format: ###
@@ -261,110 +531,9 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
         else:                    p.parent_trackid = int(trajectory['parent_id'])
         
         if supera.kINVALID_TRACKID in [p.trackid, p.parent_trackid]:
-            print('Unexpected to have an invalid track ID', p.trackid,
-                  'or parent track ID', p.parent_trackid)
+            logger.error('Unexpected to have an invalid track ID %d or parent track ID %d',
+                         p.trackid, p.parent_trackid)
             raise ValueError
 
-        # TODO Threw this in as a stopgap, what do we actually do?
-        p.ancestor_pdg = 0
-        
+        # The ancestor is filled by ReadEvent once the whole event is known
         return p
-        
-    def SetProcessType(self, edepsim_part, supera_part, supera_parent):
-        pdg_code    = supera_part.pdg
-        g4type_main = edepsim_part['start_process']
-        g4type_sub  = edepsim_part['start_subprocess']
-        
-        supera_part.process = '%d::%d' % (int(g4type_main),int(g4type_sub))
-
-        ke = np.sqrt(pow(supera_part.px,2)+pow(supera_part.py,2)+pow(supera_part.pz,2))
-
-        dr = 1.e20
-        if supera_parent:
-            dx = (supera_parent.end_pt.pos.x - supera_part.vtx.pos.x)
-            dy = (supera_parent.end_pt.pos.y - supera_part.vtx.pos.y)
-            dz = (supera_parent.end_pt.pos.z - supera_part.vtx.pos.z)
-            dr = dx + dy + dz
-        
-        if pdg_code == 2112 or pdg_code > 1000000000:
-            supera_part.type = supera.kNeutron
-        
-        elif supera_part.trackid == supera_part.parent_trackid:
-            supera_part.type = supera.kPrimary
-            
-        elif pdg_code == 22:
-            supera_part.type = supera.kPhoton
-        
-        elif abs(pdg_code) == 11:
-            
-            if g4type_main == TG4TrajectoryPoint.G4ProcessType.kProcessElectromagetic:
-                
-                if g4type_sub == TG4TrajectoryPoint.G4ProcessSubtype.kSubtypeEMPhotoelectric:
-                    supera_part.type = supera.kPhotoElectron
-                    
-                elif g4type_sub == TG4TrajectoryPoint.G4ProcessSubtype.kSubtypeEMComptonScattering:
-                    supera_part.type = supera.kCompton
-                
-                elif g4type_sub == TG4TrajectoryPoint.G4ProcessSubtype.kSubtypeEMGammaConversion or \
-                     g4type_sub == TG4TrajectoryPoint.G4ProcessSubtype.kSubtypeEMPairProdByCharged:
-                    supera_part.type = supera.kConversion
-                    
-                elif g4type_sub == TG4TrajectoryPoint.G4ProcessSubtype.kSubtypeEMIonization:
-                    
-                    if abs(supera_part.parent_pdg) == 11:
-                        supera_part.type = supera.kIonization
-                        
-                    elif abs(supera_part.parent_pdg) in [211,13,2212,321]:
-                        supera_part.type = supera.kDelta
-
-                    elif supera_part.parent_pdg == 22:
-                        supera_part.type = supera.kCompton
-
-                    else:
-                        print("    WARNING: UNEXPECTED CASE for IONIZATION ")
-                        print("      PDG",pdg_code,
-                              "TrackId",edepsim_part['trackID'],
-                              "Kinetic Energy",ke,
-                              "Parent PDG",supera_part.parent_pdg ,
-                              "Parent TrackId",edepsim_part['parentID'],
-                              "G4ProcessType",g4type_main ,
-                              "SubProcessType",g4type_sub)
-                        supera_part.type = supera.kIonization
-                #elif g4type_sub == 151:
-
-                else:
-                    print("    WARNING: UNEXPECTED EM SubType ")
-                    print("      PDG",pdg_code,
-                          "TrackId",edepsim_part['trackID'],
-                          "Kinetic Energy",ke,
-                          "Parent PDG",supera_part.parent_pdg ,
-                          "Parent TrackId",edepsim_part['parentID'],
-                          "G4ProcessType",g4type_main ,
-                          "SubProcessType",g4type_sub)
-                    raise ValueError
-                    
-            elif g4type_main == TG4TrajectoryPoint.G4ProcessType.kProcessDecay:
-                supera_part.type = supera.kDecay
-
-            elif g4type_main == TG4TrajectoryPoint.G4ProcessType.kProcessHadronic and g4type_sub == 151 and dr<0.0001:
-                if ke < self._electron_energy_threshold:
-                    supera_part.type = supera.kIonization
-                else:
-                    supera_part.type = supera.kDecay
-            
-            else:
-                print("    WARNING: Guessing the shower type as", "Compton" if ke < self._electron_energy_threshold else "OtherShower")
-                print("      PDG",pdg_code,
-                      "TrackId",edepsim_part['trackID'],
-                      "Kinetic Energy",ke,
-                      "Parent PDG",supera_part.parent_pdg ,
-                      "Parent TrackId",edepsim_part['parentID'],
-                      "G4ProcessType",g4type_main ,
-                      "SubProcessType",g4type_sub)
-
-                if ke < self._electron_energy_threshold:
-                    supera_part.type = supera.kCompton
-                else:
-                    supera_part.type = supera.kOtherShower
-        else:
-            supera_part.type = supera.kTrack
@@ -0,0 +1,85 @@
+import logging
+import sys
+
+LOGGER_NAME = 'flow2supera'
+
+# Supera LogLevel names (as used in the YAML configs) to logging levels
+LOG_LEVELS = {'VERBOSE': logging.DEBUG,
+              'DEBUG':   logging.DEBUG,
+              'INFO':    logging.INFO,
+              'WARNING': logging.WARNING,
+              'ERROR':   logging.ERROR,
+              'FATAL':   logging.CRITICAL}
+
+
+def get_logger(name=LOGGER_NAME):
+    '''
+    Return the logger for a flow2supera module (a child of the "flow2supera" logger).
+    '''
+    if name != LOGGER_NAME and not name.startswith(LOGGER_NAME + '.'):
+        name = LOGGER_NAME + '.' + name
+    return logging.getLogger(name)
+
+
+def set_log_level(level):
+    '''
+    Set the level of all flow2supera loggers from a config LogLevel name or a
+    logging level.
+    '''
+    if isinstance(level, str):
+        if not level.upper() in LOG_LEVELS:
+            raise ValueError('Unknown LogLevel %s (options: %s)' % (level, list(LOG_LEVELS)))
+        level = LOG_LEVELS[level.upper()]
+    logging.getLogger(LOGGER_NAME).setLevel(level)
+
+
+def setup_logging(level=None):
+    '''
+    Print flow2supera messages to stdout, for the entry points (run_supera and
+    the scripts). The handler is attached once, and only if the application
+    has not configured one for the flow2supera logger itself. The level is set
+    to level, or to INFO if no level was set yet.
+    '''
+    logger = logging.getLogger(LOGGER_NAME)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+    if level is not None:
+        set_log_level(level)
+    elif logger.level == logging.NOTSET:
+        logger.setLevel(logging.INFO)
+
+
+class WarningCounter:
+    '''
+    Aggregates repeated warnings by key. The first max_reports occurrences of
+    a key are logged in full, later ones are only counted, and Summary() logs
+    one "<key> xN" line per key. Message arguments are formatted lazily, so a
+    suppressed warning costs a dictionary update.
+    '''
+
+    def __init__(self, logger, max_reports=5):
+        self._logger = logger
+        self.max_reports = max_reports
+        self._counts = {}
+
+    def Warn(self, key, message, *args):
+        count = self._counts.get(key, 0) + 1
+        self._counts[key] = count
+        if count <= self.max_reports:
+            self._logger.warning(key + ': ' + message, *args)
+            if count == self.max_reports:
+                self._logger.warning('%s: reported %d times, only counting from now on', key, count)
+
+    def Count(self, key):
+        return self._counts.get(key, 0)
+
+    def Summary(self):
+        for key, count in sorted(self._counts.items()):
+            self._logger.warning('%s x%d', key, count)
+
+    def Reset(self):
+        self._counts = {}
+
@@ -4,20 +4,30 @@ import os
 with np.load(os.path.join(os.path.dirname(__file__),'pdg_data/pdg.npz'),'r') as f:
     _PDG_DATA = dict(f)
 
+# Lookup table sorted by PDG code, masses in MeV
+_PDG_ORDER = np.argsort(_PDG_DATA['pdg_code'], kind='stable')
+_SORTED_PDG_CODES = _PDG_DATA['pdg_code'][_PDG_ORDER].astype(np.int64)
+_SORTED_MASSES = _PDG_DATA['mass'][_PDG_ORDER]*1000.
+assert len(np.unique(_SORTED_PDG_CODES)) == len(_SORTED_PDG_CODES)
+
 def pdg2mass(pdg_code):
     '''
-    Given a PDG code, return the mass in MeV.
+    Given a PDG code, return the mass in MeV, or -1 if the code is unknown.
     If the PDG code is 10 digits = a nucleus, it returns atomic number x 1000.
+    Accepts a scalar or an array of codes; an array returns an array of masses.
     '''
-    if pdg_code > 1000000000:
-        return int(str(pdg_code)[-4:-1])*1000.
+    codes = np.asarray(pdg_code, dtype=np.int64)
+    scalar = codes.ndim == 0
+    codes = np.atleast_1d(codes)
 
-    where = np.where(_PDG_DATA['pdg_code']==pdg_code)[0]
-    if len(where)<1:
-        return -1
-    assert len(where) == 1
-    return _PDG_DATA['mass'][where[0]]*1000.
+    positions = np.minimum(np.searchsorted(_SORTED_PDG_CODES, codes), len(_SORTED_PDG_CODES) - 1)
+    masses = np.where(_SORTED_PDG_CODES[positions] == codes, _SORTED_MASSES[positions], -1.)
+    # Nuclei are 10LZZZAAAI: the mass number is the AAA digits
+    masses = np.where(codes > 1000000000, (codes // 10) % 1000 * 1000., masses)
 
+    if scalar:
+        return masses[0]
+    return masses
 
 '''
 import ROOT
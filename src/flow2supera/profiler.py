@@ -0,0 +1,168 @@
+import csv
+import os
+import threading
+import time
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+CSV_HEADER = ['entry', 'name', 'kind', 'value']
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        stack = self._profiler._Stack()
+        stack.append(self._name)
+        self._full_name = '/'.join(stack)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self._start
+        self._profiler._Stack().pop()
+        self._profiler._Add(self._full_name, 'time', elapsed)
+        return False
+
+
+class Profiler:
+    '''
+    Named, nested timers and counters for the conversion loop.
+
+    Timers opened inside another timer are recorded as "outer/inner". Values
+    accumulate until EndEvent(), which appends them to the CSV log as
+    (entry, name, kind, value) rows and flushes, so a job that dies keeps
+    everything up to its last finished event. When disabled, Timer() and
+    Count() return immediately.
+
+    Each thread keeps its own timer stack. With a prefetching reader, its
+    read timers are booked to the event being converted when they finish.
+    '''
+
+    def __init__(self, log_file=None, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._values = {}
+        self._totals = {}
+        self._num_events = 0
+        self._file = None
+        self._writer = None
+        self.Open(log_file)
+
+    def Open(self, log_file):
+        '''
+        Write the values of the following events to log_file, closing the previous log.
+        '''
+        self.Close()
+        if self.enabled and log_file:
+            self._file = open(log_file, 'w', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(CSV_HEADER)
+
+    def _Stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _Add(self, name, kind, value):
+        with self._lock:
+            key = (name, kind)
+            self._values[key] = self._values.get(key, 0) + value
+
+    def Timer(self, name):
+        '''
+        Return a context manager that adds its elapsed time to the named timer.
+        '''
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def Record(self, name, seconds):
+        '''
+        Add an externally measured duration to the named timer.
+        '''
+        if not self.enabled:
+            return
+        self._Add(name, 'time', seconds)
+
+    def Count(self, name, value=1):
+        '''
+        Add value to the named counter of the current event.
+        '''
+        if not self.enabled:
+            return
+        self._Add(name, 'count', value)
+
+    def EndEvent(self, entry):
+        '''
+        Write the current event's values to the log and add them to the run totals.
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            values, self._values = self._values, {}
+            self._num_events += 1
+            for key, value in values.items():
+                total = self._totals.setdefault(key, [0, 0])
+                total[0] += value
+                total[1] = max(total[1], value)
+        if self._writer:
+            for (name, kind), value in sorted(values.items()):
+                self._writer.writerow([entry, name, kind, value])
+            self._file.flush()
+
+    def Summary(self):
+        '''
+        Log the per-event mean, maximum and run total of every timer and counter.
+        '''
+        if not self.enabled or not self._num_events:
+            return
+        logger.info('---------------- Profile over %d events ----------------', self._num_events)
+        logger.info('{:<40s} {:>6s} {:>12s} {:>12s} {:>12s}'.format('name', 'kind', 'mean', 'max', 'total'))
+        for (name, kind), (total, maximum) in sorted(self._totals.items()):
+            logger.info('{:<40s} {:>6s} {:>12.4g} {:>12.4g} {:>12.4g}'.format(
+                name, kind, total / self._num_events, maximum, total))
+
+    def Close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+            self._writer = None
+
+
+def merge_logs(in_files, out_file):
+    '''
+    Concatenate CSV profile logs, in the order given, under a single header.
+    '''
+    with open(out_file, 'w', newline='') as fout:
+        writer = csv.writer(fout)
+        writer.writerow(CSV_HEADER)
+        for in_file in in_files:
+            if not os.path.isfile(in_file):
+                logger.warning('Missing profile log %s', in_file)
+                continue
+            with open(in_file, 'r', newline='') as fin:
+                rows = csv.reader(fin)
+                next(rows, None)
+                writer.writerows(rows)
+
+
+# Shared disabled profiler used when no profiling is requested
+NULL_PROFILER = Profiler(enabled=False)
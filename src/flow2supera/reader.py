@@ -1,8 +1,387 @@
 import h5py 
-import h5flow
+import collections
+import hashlib
+import os
 import numpy as np
 #from ROOT import supera
-import cppyy
+from .profiler import NULL_PROFILER
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+
+def _read_region(dataset, ids, id_field):
+    '''
+    Return the rows of dataset whose id_field value is in ids.
+    In ndlar_flow truth tables the IDs double as row indices, so only the
+    contiguous region spanning the requested IDs is read from the file.
+    '''
+    ids = np.unique(ids)
+    ids = ids[ids >= 0]
+    if len(ids) == 0:
+        return dataset[0:0]
+    region = dataset[int(ids[0]):int(ids[-1]) + 1]
+    return region[np.isin(region[id_field], ids)]
+
+
+def _gather_rows(dataset, rows):
+    '''
+    Return dataset[rows] for sorted, unique row indices in a single read.
+    Dense requests are served from one contiguous region read; sparse ones
+    fall back to a point selection, which h5py requires to be increasing.
+    '''
+    if len(rows) == 0:
+        return dataset[0:0]
+    region_start = int(rows[0])
+    region_stop = int(rows[-1]) + 1
+    if isinstance(dataset, np.ndarray) or region_stop - region_start <= 4 * len(rows):
+        return dataset[region_start:region_stop][rows - region_start]
+    return dataset[rows]
+
+
+class FieldProjection:
+    '''
+    Read-only view of a compound HDF5 dataset that reads only the given fields.
+    Supports the slicing, sorted row lists and len() the reader uses, and
+    returns packed structured arrays with just those fields.
+    '''
+
+    def __init__(self, dataset, fields):
+        missing = [name for name in fields if not name in dataset.dtype.names]
+        if missing:
+            raise KeyError('Fields %s missing from dataset %s' % (missing, dataset.name))
+        self._dataset = dataset
+        self._fields = list(fields)
+        self.dtype = np.dtype([(name, dataset.dtype.fields[name][0]) for name in fields])
+        self.shape = dataset.shape
+        self.chunks = dataset.chunks
+        self.name = dataset.name
+
+    def __len__(self):
+        return len(self._dataset)
+
+    def __getitem__(self, key):
+        return self._dataset.fields(self._fields)[key]
+
+
+class BlockCache:
+    '''
+    Size-bounded LRU cache of contiguous row blocks of one HDF5 dataset.
+    Blocks are aligned to the dataset's chunks and hold whole chunks, so a
+    compressed chunk shared by consecutive events is decompressed once and
+    each event is served as a view of the cached block.
+    '''
+
+    # Target size of one block; the block holds at least one chunk
+    BLOCK_BYTES = 1<<24
+
+    def __init__(self, dataset, max_bytes):
+        self._dataset = dataset
+        self._num_rows = len(dataset)
+        row_bytes = max(dataset.dtype.itemsize, 1)
+        chunk_rows = dataset.chunks[0] if dataset.chunks else 1
+        # At least two blocks fit in the cache so that a read spanning a boundary does not thrash
+        block_bytes = max(min(self.BLOCK_BYTES, max_bytes // 2), 1)
+        self.block_rows = max(block_bytes // (row_bytes * chunk_rows), 1) * chunk_rows
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = collections.OrderedDict()
+
+    def _Block(self, block_index):
+        block = self._blocks.get(block_index)
+        if block is not None:
+            self._blocks.move_to_end(block_index)
+            self.hits += 1
+            return block
+        self.misses += 1
+        start = block_index * self.block_rows
+        block = self._dataset[start:min(start + self.block_rows, self._num_rows)]
+        # Events are handed out as views, which must not modify the cache
+        block.flags.writeable = False
+        self._blocks[block_index] = block
+        self.num_bytes += block.nbytes
+        while self.num_bytes > self.max_bytes and len(self._blocks) > 1:
+            _, evicted = self._blocks.popitem(last=False)
+            self.num_bytes -= evicted.nbytes
+        return block
+
+    def Read(self, start, stop):
+        '''
+        Return rows [start, stop): a view of a cached block when the range lies
+        within one block, otherwise a concatenation of the pieces.
+        '''
+        start = int(start)
+        stop = min(int(stop), self._num_rows)
+        if stop <= start:
+            return self._dataset[0:0]
+        first_block = start // self.block_rows
+        last_block = (stop - 1) // self.block_rows
+        pieces = []
+        for block_index in range(first_block, last_block + 1):
+            block_start = block_index * self.block_rows
+            block = self._Block(block_index)
+            pieces.append(block[max(start - block_start, 0):stop - block_start])
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces)
+
+
+def count_events(input_file):
+    '''
+    Return the number of charge events in an ndlar_flow file without loading it.
+    '''
+    with h5py.File(input_file, 'r') as fin:
+        return len(fin['charge/events/data'])
+
+def file_hash(input_file, num_samples=16, sample_size=1<<16):
+    '''
+    Return a content hash of a file that is cheap to compute for large files.
+    The file size and evenly spaced blocks (always including the first and the
+    last) are hashed instead of the whole content, together with the file's
+    inode and modification time so that a rewritten file gets a new hash even
+    if the sampled blocks did not change.
+    '''
+    stat = os.stat(input_file)
+    file_size = stat.st_size
+    digest = hashlib.sha1(('%d:%d:%d' % (file_size, stat.st_ino, stat.st_mtime_ns)).encode())
+    offsets = np.linspace(0, max(file_size - sample_size, 0), num_samples).astype(np.int64)
+    with open(input_file, 'rb') as fin:
+        for offset in np.unique(offsets):
+            fin.seek(int(offset))
+            digest.update(fin.read(sample_size))
+    return digest.hexdigest()
+
+
+class TruthIndex:
+    '''
+    CSR-style index from an event (its row in the charge/events ref_region) to
+    the sorted, unique segment and trajectory rows it touches. Trajectory rows
+    include the parents of the contributing trajectories.
+    '''
+
+    KEYS = ('segment_offsets', 'segment_rows', 'trajectory_offsets', 'trajectory_rows')
+
+    # Backtracked hits resolved per pass when building, bounding memory use
+    HITS_PER_CHUNK = 100000
+
+    def __init__(self, segment_offsets, segment_rows, trajectory_offsets, trajectory_rows):
+        self.segment_offsets = segment_offsets
+        self.segment_rows = segment_rows
+        self.trajectory_offsets = trajectory_offsets
+        self.trajectory_rows = trajectory_rows
+
+    def __len__(self):
+        return len(self.segment_offsets) - 1
+
+    def SegmentRows(self, event_index):
+        return self.segment_rows[self.segment_offsets[event_index]:self.segment_offsets[event_index + 1]]
+
+    def TrajectoryRows(self, event_index):
+        return self.trajectory_rows[self.trajectory_offsets[event_index]:self.trajectory_offsets[event_index + 1]]
+
+    def Save(self, path):
+        # Write under a temporary name first so concurrent readers never see a partial file
+        temp_path = '%s.%d.tmp.npz' % (path, os.getpid())
+        np.savez(temp_path, **{key: getattr(self, key) for key in self.KEYS})
+        os.replace(temp_path, path)
+
+    @classmethod
+    def Load(cls, path):
+        with np.load(path) as data:
+            return cls(*[data[key] for key in cls.KEYS])
+
+    def Matches(self, num_events, num_segments, num_trajectories):
+        '''
+        Check that the index fits tables of the given sizes.
+        '''
+        return (len(self) == num_events
+                and self.segment_offsets[-1] == len(self.segment_rows)
+                and self.trajectory_offsets[-1] == len(self.trajectory_rows)
+                and int(self.segment_rows.max(initial=-1)) < num_segments
+                and int(self.trajectory_rows.max(initial=-1)) < num_trajectories)
+
+    @classmethod
+    def Build(cls, event_hit_indices, backtracked_hits, segments, trajectories):
+        '''
+        Derive the index from the event hit ref_region and the backtracked hits,
+        resolving a block of events at a time with the same vectorized
+        hits->segments->trajectories mapping as FlowReader.GetEventTruthFromHits.
+        '''
+        regions = event_hit_indices[()]
+        hit_starts = regions['start'].astype(np.int64)
+        hit_stops = regions['stop'].astype(np.int64)
+        hit_counts = np.maximum(hit_stops - hit_starts, 0)
+        num_events = len(regions)
+
+        # Split events into blocks of roughly HITS_PER_CHUNK hits (at least one event each)
+        cumulative_hits = np.cumsum(hit_counts)
+        block_edges = np.searchsorted(cumulative_hits,
+                                      np.arange(cls.HITS_PER_CHUNK, cumulative_hits[-1] if num_events else 0,
+                                                cls.HITS_PER_CHUNK),
+                                      side='right')
+        block_edges = np.unique(np.concatenate([[0], block_edges, [num_events]]))
+
+        segment_counts = np.zeros(num_events, dtype=np.int64)
+        trajectory_counts = np.zeros(num_events, dtype=np.int64)
+        segment_rows = []
+        trajectory_rows = []
+        for block_start, block_stop in zip(block_edges[:-1], block_edges[1:]):
+            if block_stop <= block_start:
+                continue
+            starts = hit_starts[block_start:block_stop]
+            counts = hit_counts[block_start:block_stop]
+            if counts.sum() == 0:
+                continue
+            region_start = int(starts[counts > 0].min())
+            region_stop = int((starts + counts)[counts > 0].max())
+            block_hits = backtracked_hits[region_start:region_stop]
+
+            # Row of every hit of every event in the block, and the event it belongs to
+            hit_events = np.repeat(np.arange(block_start, block_stop), counts)
+            first_hit = np.repeat(np.cumsum(counts) - counts, counts)
+            hit_rows = np.arange(counts.sum()) - first_hit + np.repeat(starts, counts) - region_start
+
+            fractions = block_hits['fraction'][hit_rows]
+            contributor_mask = fractions != 0
+            contributor_events = np.broadcast_to(hit_events[:, None], fractions.shape)[contributor_mask]
+            contributor_segments = block_hits['segment_id'][hit_rows][contributor_mask].astype(np.int64)
+
+            events, block_segment_rows = _unique_pairs(contributor_events, contributor_segments)
+            segment_counts += np.bincount(events, minlength=num_events)
+            segment_rows.append(block_segment_rows)
+
+            unique_segment_rows, segment_inverse = np.unique(block_segment_rows, return_inverse=True)
+            segment_trajectories = _gather_rows(segments, unique_segment_rows)['traj_id'].astype(np.int64)
+            pair_trajectories = segment_trajectories[segment_inverse]
+            unique_trajectory_rows, trajectory_inverse = np.unique(pair_trajectories, return_inverse=True)
+            trajectory_parents = _gather_rows(trajectories, unique_trajectory_rows)['parent_id'].astype(np.int64)
+            pair_parents = trajectory_parents[trajectory_inverse]
+
+            # Parents are needed by the driver even when they leave no segment themselves
+            is_parent = pair_parents >= 0
+            events, block_trajectory_rows = _unique_pairs(
+                np.concatenate([events, events[is_parent]]),
+                np.concatenate([pair_trajectories, pair_parents[is_parent]]))
+            trajectory_counts += np.bincount(events, minlength=num_events)
+            trajectory_rows.append(block_trajectory_rows)
+
+        def concatenate(rows):
+            return np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+        return cls(np.concatenate([[0], np.cumsum(segment_counts)]),
+                   concatenate(segment_rows),
+                   np.concatenate([[0], np.cumsum(trajectory_counts)]),
+                   concatenate(trajectory_rows))
+
+
+class ColumnStore:
+    '''
+    Uncompressed .npy copies of the large datasets of one input file, in a
+    directory keyed by the file's content hash. Exported once, the arrays are
+    attached with np.load(mmap_mode='r'), so every reader on the node shares
+    the same page cache instead of decompressing its own copy. Point it at
+    local scratch or /dev/shm.
+    '''
+
+    # Dataset name -> path in the ndlar_flow file
+    DATASETS = {'hits': 'charge/calib_final_hits/data',
+                'backtracked_hits': 'mc_truth/calib_final_hit_backtrack/data',
+                'segments': 'mc_truth/segments/data',
+                'trajectories': 'mc_truth/trajectories/data'}
+
+    # Bytes copied per read while exporting, bounding memory use
+    BYTES_PER_CHUNK = 1<<26
+
+    def __init__(self, store_dir, input_file):
+        self.path = os.path.join(store_dir, '%s.%s.columns' % (
+            os.path.basename(input_file), file_hash(input_file)[:16]))
+
+    def FileName(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    def Exists(self):
+        return all(os.path.isfile(self.FileName(name)) for name in self.DATASETS)
+
+    def Export(self, fin):
+        '''
+        Copy the datasets of an open h5py file into the store chunk by chunk.
+        Each array is written under a temporary name first, so concurrent
+        readers never attach a partial file.
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        for name, dataset_path in self.DATASETS.items():
+            if os.path.isfile(self.FileName(name)):
+                continue
+            dataset = fin[dataset_path]
+            temp_path = '%s.%d.tmp.npy' % (self.FileName(name), os.getpid())
+            column = np.lib.format.open_memmap(temp_path, mode='w+', dtype=dataset.dtype, shape=dataset.shape)
+            rows_per_chunk = max(1, self.BYTES_PER_CHUNK // max(dataset.dtype.itemsize, 1))
+            for start in range(0, len(dataset), rows_per_chunk):
+                column[start:start + rows_per_chunk] = dataset[start:start + rows_per_chunk]
+            column.flush()
+            del column
+            os.replace(temp_path, self.FileName(name))
+
+    def Matches(self, fin):
+        '''
+        Check that the stored arrays have the shape and type of the datasets of
+        an open h5py file.
+        '''
+        for name, dataset_path in self.DATASETS.items():
+            column = np.load(self.FileName(name), mmap_mode='r')
+            if column.shape != fin[dataset_path].shape or column.dtype != fin[dataset_path].dtype:
+                return False
+        return True
+
+    def Remove(self):
+        for name in self.DATASETS:
+            if os.path.isfile(self.FileName(name)):
+                os.remove(self.FileName(name))
+
+    def Attach(self):
+        '''
+        Return the read-only memory-mapped arrays by dataset name.
+        '''
+        return {name: np.load(self.FileName(name), mmap_mode='r') for name in self.DATASETS}
+
+
+def export_columns(input_file, store_dir):
+    '''
+    Export the column store of input_file into store_dir unless a store that
+    matches the file exists already.
+    '''
+    store = ColumnStore(store_dir, input_file)
+    with h5py.File(input_file, 'r') as fin:
+        if store.Exists() and not store.Matches(fin):
+            logger.warning('Column store %s does not match %s, exporting it again', store.path, input_file)
+            store.Remove()
+        if not store.Exists():
+            logger.info('Exporting columns of %s to %s', input_file, store.path)
+            store.Export(fin)
+    return store
+
+
+def build_truth_index(input_file, truth_index_dir, column_store_dir=None):
+    '''
+    Build the truth index of input_file into truth_index_dir unless an index
+    that matches the file exists already.
+    '''
+    reader = FlowReader(None, input_file, truth_index=True, truth_index_dir=truth_index_dir,
+                        column_store_dir=column_store_dir, read_flashes=False)
+    reader.ReadFile(input_file)
+    reader.CloseFile()
+
+
+def _unique_pairs(events, rows):
+    '''
+    Return the unique (event, row) pairs sorted by event, then row.
+    '''
+    row_range = int(rows.max(initial=0)) + 1
+    keys = np.unique(events.astype(np.int64) * row_range + rows)
+    return keys // row_range, keys % row_range
+
 
 class InputEvent:
     event_id = -1
@@ -14,16 +393,39 @@ class InputEvent:
     trajectories = None
     interactions = None
     t0 = -1
+    entry = -1
+    file_index = -1
+    file_name = ''
     segment_index_min = -1
     event_separator = ''
+    flashes = None
 
 
 class FlowReader:
+
+    # Fields read from each dataset unless read_all_fields is set: what the
+    # truth lookups and SuperaDriver (ReadEvent, ParticleTable, EDeps) use
+    HIT_FIELDS = ('x', 'y', 'z', 't_drift', 'E')
+    BACKTRACK_FIELDS = ('fraction', 'segment_id')
+    SEGMENT_FIELDS = ('segment_id', 'traj_id', 'dEdx')
+    TRAJECTORY_FIELDS = ('event_id', 'vertex_id', 'traj_id', 'local_traj_id', 'parent_id',
+                         'E_start', 'pxyz_start', 'xyz_start', 't_start', 'xyz_end', 't_end',
+                         'pdg_id', 'start_process', 'start_subprocess')
     
-    def __init__(self, parser_run_config, input_files=None):
-        self._input_files = input_files
-        if not isinstance(input_files, str):
-            raise TypeError('Input file must be a str type')
+    def __init__(self, parser_run_config, input_files=None, cache_truth=False,
+                 truth_index=False, truth_index_dir=None, column_store_dir=None,
+                 block_cache_size=0, rdcc_nbytes=None, rdcc_nslots=None,
+                 read_all_fields=False, read_flashes=True,
+                 flash_match='ref', flash_window=(0., 0.), flash_time_scale=1.):
+        if isinstance(input_files, str):
+            input_files = [input_files]
+        if input_files is None:
+            input_files = []
+        if not all(isinstance(input_file, str) for input_file in input_files):
+            raise TypeError('Input files must be a str or a list of str')
+        self._input_files = list(input_files)
+        self._file = None
+        self._file_index = -1
         self._event_ids = None
         self._event_t0s = None
         self._flash_t0s = None
@@ -36,133 +438,319 @@ class FlowReader:
         self._interactions = None
         self._run_config = parser_run_config
         self._is_sim = False
-
-        if input_files:
-            self.ReadFile(input_files)
+        self._cache_truth = cache_truth
+        self._use_truth_index = truth_index
+        self._truth_index_dir = truth_index_dir
+        self._column_store_dir = column_store_dir
+        self._block_cache_size = block_cache_size
+        self._rdcc = {key: value for key, value in (('rdcc_nbytes', rdcc_nbytes),
+                                                    ('rdcc_nslots', rdcc_nslots)) if value}
+        self._hit_cache = None
+        self._backtrack_cache = None
+        self._read_all_fields = read_all_fields
+        self._read_flashes = read_flashes
+        self._flash_reader = None
+        self._light_regions = None
+        self._light_refs = None
+        if not flash_match in ('ref', 'time'):
+            raise ValueError('Unknown flash matching %s (options: ref, time)' % flash_match)
+        self._flash_match = flash_match
+        self._flash_window = flash_window
+        self._flash_time_scale = flash_time_scale
+        self._flash_matches = None
+        self._truth_index = None
+        self.profiler = NULL_PROFILER
+        self.selection = None
+
+        # Files are opened lazily, one at a time, as the event stream reaches them.
+        # Only the per-file event counts are needed up front.
+        event_counts = [count_events(input_file) for input_file in self._input_files]
+        self._file_offsets = np.concatenate([[0], np.cumsum(event_counts)]).astype(np.int64)
 
     def __len__(self):
-        if self._event_ids is None: return 0
-        return len(self._event_ids)
+        return int(self._file_offsets[-1])
 
     
     def __iter__(self):
-        for entry in range(len(self)):
+        for entry in self.Entries():
             yield self.GetEvent(entry)
 
-    def ReadFile(self, input_files, verbose=False):
-        event_ids = []
-        calib_final_hits  = []
-        event_hit_indices = []
-        hits = []
-        backtracked_hits = []
-        segments = []
-        trajectories = []
-        event_trajectories = []
-        t0s = []
+    def Entries(self):
+        '''
+        Entries of the combined event stream to read: the selection if one is set, otherwise all.
+        '''
+        if self.selection is None:
+            return np.arange(len(self))
+        return self.selection
+
+    def HitCounts(self, entries=None):
+        '''
+        Return the number of hits of the given entries (all if None), read from
+        the hit ref_region of each file. No hit data is read.
+        '''
+        counts = np.zeros(len(self), dtype=np.int64)
+        for file_index, input_file in enumerate(self._input_files):
+            with h5py.File(input_file, 'r') as fin:
+                event_ids = fin['charge/events/data'].fields('id')[()]
+                hit_regions = fin['charge/events/ref/charge/calib_final_hits/ref_region'][()]
+            event_regions = hit_regions[event_ids]
+            start, stop = self._file_offsets[file_index], self._file_offsets[file_index + 1]
+            counts[start:stop] = event_regions['stop'] - event_regions['start']
+        if entries is None:
+            return counts
+        return counts[np.asarray(entries, dtype=np.int64)]
+
+    def EventColumns(self, file_index):
+        '''
+        Return the event-level columns of one input file as a dict of arrays:
+        every field of charge/events/data plus num_hits from the hit ref_region
+        and entry, the index of each event in the combined stream. No hit data is read.
+        '''
+        with h5py.File(self._input_files[file_index], 'r') as fin:
+            events_data = fin['charge/events/data'][()]
+            hit_regions = fin['charge/events/ref/charge/calib_final_hits/ref_region'][()]
+        columns = {name: events_data[name] for name in events_data.dtype.names}
+        # Events are looked up by ID in the ref_region, as in GetEvent
+        event_regions = hit_regions[events_data['id']]
+        columns['num_hits'] = (event_regions['stop'] - event_regions['start']).astype(np.int64)
+        columns['entry'] = self._file_offsets[file_index] + np.arange(len(events_data))
+        return columns
+
+    def Select(self, event_ids=None, mask=None, predicate=None, min_hits=0):
+        '''
+        Restrict iteration to the events that pass every given criterion and
+        return their entries:
+          event_ids: event IDs (charge/events 'id') to keep
+          mask: boolean array over all entries of the combined stream
+          predicate: function of the EventColumns() dict of a file returning a boolean array
+          min_hits: minimum number of hits
+        Only event-level data is read, so rejected events cost no hit or truth reads.
+        Calling it with no criteria clears the selection.
+        '''
+        selected = np.ones(len(self), dtype=bool)
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            if mask.shape != selected.shape:
+                raise ValueError('Selection mask has %d entries, expected %d' % (len(mask), len(self)))
+            selected &= mask
+
+        if event_ids is not None or predicate is not None or min_hits > 0:
+            for file_index in range(len(self._input_files)):
+                start, stop = self._file_offsets[file_index], self._file_offsets[file_index + 1]
+                if not selected[start:stop].any():
+                    continue
+                columns = self.EventColumns(file_index)
+                if event_ids is not None:
+                    selected[start:stop] &= np.isin(columns['id'], np.asarray(event_ids))
+                if predicate is not None:
+                    selected[start:stop] &= np.asarray(predicate(columns), dtype=bool)
+                if min_hits > 0:
+                    selected[start:stop] &= columns['num_hits'] >= min_hits
+
+        if event_ids is None and mask is None and predicate is None and min_hits <= 0:
+            self.selection = None
+        else:
+            self.selection = np.nonzero(selected)[0]
+        return self.Entries()
+
+    def EventKey(self, entry):
+        '''
+        Map an entry of the combined event stream to (file index, event index in that file).
+        '''
+        file_index = int(np.searchsorted(self._file_offsets, entry, side='right')) - 1
+        return file_index, int(entry - self._file_offsets[file_index])
+
+    def CloseFile(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._file_index = -1
+        self._truth_index = None
+        self._hit_cache = None
+        self._backtrack_cache = None
+        self._flash_reader = None
+        self._light_regions = None
+        self._light_refs = None
+        self._flash_matches = None
+
+    def TruthIndexPath(self, input_file):
+        '''
+        Cache file of the truth index of input_file, keyed by the file's content hash.
+        '''
+        if self._truth_index_dir is None:
+            return None
+        return os.path.join(self._truth_index_dir, '%s.%s.truth_index.npz' % (
+            os.path.basename(input_file), file_hash(input_file)[:16]))
 
-        print('Reading input file...')
+    def LoadTruthIndex(self, input_file):
+        '''
+        Load the truth index of the current file from the cache, or build it
+        from the open datasets and store it in the cache if one is configured.
+        '''
+        index_path = self.TruthIndexPath(input_file)
+        if index_path and os.path.isfile(index_path):
+            logger.info('Loading truth index %s', index_path)
+            self._truth_index = TruthIndex.Load(index_path)
+            if self._truth_index.Matches(len(self._event_hit_indices), len(self._segments),
+                                         len(self._trajectories)):
+                return
+            logger.warning('Truth index %s does not match %s, rebuilding it', index_path, input_file)
+        logger.info('Building truth index...')
+        self._truth_index = TruthIndex.Build(self._event_hit_indices,
+                                             self._backtracked_hits,
+                                             self._segments,
+                                             self._trajectories)
+        if index_path:
+            os.makedirs(self._truth_index_dir, exist_ok=True)
+            self._truth_index.Save(index_path)
+
+    def ReadFile(self, input_file, verbose=False):
+
+        logger.info('Reading input file... %s', input_file)
 
         # H5Flow's H5FlowDataManager class associated datasets through references
         # These paths help us get the correct associations
-        events_path = 'charge/events/'
-        events_data_path = 'charge/events/data/'
-        event_hit_indices_path = 'charge/events/ref/charge/calib_final_hits/ref_region/'
+        events_path = 'charge/events'
+        event_hit_indices_path = 'charge/events/ref/charge/calib_final_hits/ref_region'
         calib_final_hits_path = 'charge/calib_final_hits/'
-        calib_prompt_hits_path = 'charge/calib_prompt_hits/'
         backtracked_hits_path = 'mc_truth/calib_final_hit_backtrack/data'
-        packets_path = 'charge/packets'
         interactions_path = 'mc_truth/interactions/data'
         segments_path = 'mc_truth/segments/'
         trajectories_path = 'mc_truth/trajectories/data'
 
-        self._is_sim = False 
-        # TODO Currently only reading one input file at a time. Is it 
-        # necessary to read multiple? If so, how to handle non-unique
-        # event IDs?
-        #for f in input_files:
-        flow_manager = h5flow.data.H5FlowDataManager(input_files, 'r')
-        with h5py.File(input_files, 'r') as fin:
-            events = flow_manager[events_path]
-            events_data = events['data']
-            self._event_ids = events_data['id']
-            self._event_t0s = events_data['ts_start']
-            self._event_hit_indices = flow_manager[event_hit_indices_path]
-            self._hits = flow_manager[calib_final_hits_path+'data']
-            self._backtracked_hits = flow_manager[backtracked_hits_path]
-            self._is_sim = 'mc_truth' in fin.keys()
-            if self._is_sim:
-                #self._segments = flow_manager[events_path,
-                #                              calib_final_hits_path,
-                #                              calib_prompt_hits_path,
-                #                              packets_path,
-                #                              segments_path]
-                self._segments = flow_manager[segments_path+'data']
-                self._trajectories = flow_manager[trajectories_path]
-                self._interactions = flow_manager[interactions_path]
-
-        # This next bit is only necessary if reading multiple files
-        # Stack datasets so that there's a "file index" preceding the event index
-        #self._event_ids = np.stack(event_ids)
-        #self._event_ids = np.concatenate(event_ids)
-        #self._event_t0s = np.stack(t0s)
-        #self._calib_final_hits = np.stack(calib_final_hits)
-        #self._t0s = np.stack(t0s)
-        #self._segments = np.stack(segments)
-        #self._trajectories = np.stack(trajectories)
+        # Only plain datasets are read here, so a bare h5py handle is enough and,
+        # unlike the flow manager, it can be closed once the stream moves on.
+        self.CloseFile()
+        fin = h5py.File(input_file, 'r', **self._rdcc)
+        self._file = fin
+
+        events = fin[events_path]
+        events_data = events['data']
+        self._event_ids = events_data['id']
+        self._event_t0s = events_data['ts_start']
+        self._event_hit_indices = fin[event_hit_indices_path]
+        self._hits = fin[calib_final_hits_path+'data']
+        self._backtracked_hits = fin[backtracked_hits_path]
+        self._is_sim = 'mc_truth' in fin.keys()
+        if self._is_sim:
+            self._segments = fin[segments_path+'data']
+            self._trajectories = fin[trajectories_path]
+            self._interactions = fin[interactions_path]
+
+        # Large datasets are read from the shared memory-mapped copy instead of the file
+        if self._is_sim and self._column_store_dir:
+            columns = export_columns(input_file, self._column_store_dir).Attach()
+            self._hits = columns['hits']
+            self._backtracked_hits = columns['backtracked_hits']
+            self._segments = columns['segments']
+            self._trajectories = columns['trajectories']
 
         if not self._is_sim:
-            print('Currently only simulation is supoprted')
+            logger.error('Currently only simulation is supported')
             raise NotImplementedError
 
-        
+        # Only the fields the conversion uses are read from HDF5
+        if not self._read_all_fields and isinstance(self._hits, h5py.Dataset):
+            self._hits = FieldProjection(self._hits, self.HIT_FIELDS)
+            self._backtracked_hits = FieldProjection(self._backtracked_hits, self.BACKTRACK_FIELDS)
+            self._segments = FieldProjection(self._segments, self.SEGMENT_FIELDS)
+            self._trajectories = FieldProjection(self._trajectories, self.TRAJECTORY_FIELDS)
+
+        # Whole-file truth tables are only worth holding when they fit in memory.
+        # Otherwise each event reads just the region of rows it needs.
+        if self._cache_truth:
+            self._segments = self._segments[()]
+            self._trajectories = self._trajectories[()]
+
+        if self._use_truth_index:
+            self.LoadTruthIndex(input_file)
+
+        # Flashes are attached to charge events through the flow's charge->light
+        # references, or by matching flash times to the event ts_start
+        light_path = 'charge/events/ref/light/events/'
+        if self._read_flashes and 'light/events/data' in fin:
+            if self._flash_match == 'time':
+                self._flash_reader = FlowFlashReader(self._run_config, fin)
+                time_index = FlashTimeIndex(self._flash_reader.FlashTimes())
+                starts, stops = time_index.Match(self._event_t0s * self._flash_time_scale,
+                                                 self._flash_window)
+                self._flash_matches = (time_index, starts, stops)
+            elif light_path+'ref_region' in fin:
+                self._flash_reader = FlowFlashReader(self._run_config, fin)
+                self._light_regions = fin[light_path+'ref_region'][()]
+                self._light_refs = fin[light_path+'ref']
+
+        # Memory-mapped columns are already served without decompression
+        if self._block_cache_size > 0 and not isinstance(self._hits, np.ndarray):
+            self._hit_cache = BlockCache(self._hits, self._block_cache_size // 2)
+            self._backtrack_cache = BlockCache(self._backtracked_hits, self._block_cache_size // 2)
+
     # To truth associations go as hits -> segments -> trajectories
     def GetEventTruthFromHits(self, backtracked_hits, segments, trajectories):
         '''
         The Driver class needs to know the number of event trajectories in advance.
         This function uses the backtracked hits dataset to map hits->segments->trajectories
         and fills segment and trajectory IDs corresponding to hits. 
+        The whole (n_hits, max_contributors) block is resolved at once: each unique
+        segment and trajectory is read a single time with one sorted gather.
+        The gathered rows are returned as well ('segments' and 'trajectories',
+        sorted by ID, parents included) so that they are not read again.
         '''
-        max_contributors = 100
-        #hit_threshold = 0.0001
-        #backtracked_hits = self._backtracked_hits
-        # TODO Calculate the length of this in advance and use reserve; appending is slow!
+        #from larnd2supera, 2023-09-14 YC: 
+        #I think frac_min should be allowed to be below 0 for the sake of induced current. 
+        #SK: So, only skipping 0 
+        contributor_mask = backtracked_hits['fraction'] != 0
+        segment_ids = backtracked_hits['segment_id'][contributor_mask]
+
+        unique_segment_ids, segment_inverse = np.unique(segment_ids, return_inverse=True)
+        segment_rows = _gather_rows(segments, unique_segment_ids)
+        contributor_trajectory_ids = segment_rows['traj_id'][segment_inverse]
+
+        unique_trajectory_ids, trajectory_inverse = np.unique(contributor_trajectory_ids,
+                                                              return_inverse=True)
+        trajectory_rows = _gather_rows(trajectories, unique_trajectory_ids)
+        trajectory_parent_ids = trajectory_rows['parent_id']
+        # Some trajectories' parents don't appear in the main trajectories
+        # list, but need to be seen by the driver. Add them here explicitly.
+        contributor_parent_ids = trajectory_parent_ids[trajectory_inverse]
+
+        # Only parents that are not contributors themselves need another read
+        missing_parent_ids = np.setdiff1d(trajectory_parent_ids[trajectory_parent_ids >= 0],
+                                          unique_trajectory_ids)
+        if len(missing_parent_ids):
+            trajectory_rows = np.concatenate([trajectory_rows,
+                                              _gather_rows(trajectories, missing_parent_ids)])
+            trajectory_rows = trajectory_rows[np.argsort(trajectory_rows['traj_id'], kind='stable')]
+
+        trajectory_ids = np.concatenate([contributor_trajectory_ids.astype(np.int64),
+                                         contributor_parent_ids.astype(np.int64)])
+
         truth_dict = {
-            'segment_ids': [],
-            'trajectory_ids': [],
+            'segment_ids': segment_ids,
+            'trajectory_ids': np.sort(trajectory_ids),
+            'segments': segment_rows,
+            'trajectories': trajectory_rows,
         }
 
-        segment_ids = []
-        trajectory_ids = []
-        for i_bt, backtracked_hit in enumerate(backtracked_hits):
-            for contrib in range(max_contributors):
-                if abs(backtracked_hit['fraction'][contrib]) == 0: continue
-                #from larnd2supera, 2023-09-14 YC: 
-                #I think frac_min should be allowed to be below 0 for the sake of induced current. 
-                #SK: So, only skipping 0 
-                segment_id = backtracked_hit['segment_id'][contrib]
-                segment = segments[segment_id]
-                segment_ids.append(segment_id)
-                trajectory_id = segment['traj_id']
-                trajectory = trajectories[trajectory_id]
-                trajectory_parent_id = trajectory['parent_id']
-                trajectory_ids.append(trajectory_id)
-                # Some trajectories' parents don't appear in the main trajectories
-                # list, but need to be seen by the driver. Add them here explicitly.
-                trajectory_ids.append(trajectory_parent_id)
-
-        truth_dict['segment_ids'] = segment_ids
-        truth_dict['trajectory_ids'] = sorted(trajectory_ids)
-
         return truth_dict
 
-    def GetEvent(self, event_index):
+    def GetEvent(self, entry):
         
-        if event_index >= len(self._event_ids):
-            print('Entry {} is above allowed entry index ({})'.format(event_index, len(self._event_ids)))
-            print('Invalid read request (returning None)')
+        if entry >= len(self):
+            logger.error('Entry %d is above allowed entry index (%d)', entry, len(self))
+            logger.error('Invalid read request (returning None)')
             return None
+
+        file_index, event_index = self.EventKey(entry)
+        if file_index != self._file_index:
+            with self.profiler.Timer('open'):
+                self.ReadFile(self._input_files[file_index])
+            self._file_index = file_index
         
         result = InputEvent()
+        result.entry = entry
+        result.file_index = file_index
+        result.file_name = self._input_files[file_index]
 
         result.event_id = self._event_ids[event_index]
 
@@ -172,101 +760,228 @@ class FlowReader:
         result.hit_indices = self._event_hit_indices[result.event_id]
         hit_start_index = self._event_hit_indices[result.event_id][0]
         hit_stop_index  = self._event_hit_indices[result.event_id][1]
-        result.hits = self._hits[hit_start_index:hit_stop_index]
-        result.backtracked_hits = self._backtracked_hits[hit_start_index:hit_stop_index]
-
-        truth_ids_dict = self.GetEventTruthFromHits(result.backtracked_hits, 
-                                                    self._segments, 
-                                                    self._trajectories)
-        event_trajectory_ids = truth_ids_dict['trajectory_ids']
-        trajectories_array = np.array(self._trajectories)
-        result.trajectories = trajectories_array[np.isin(trajectories_array['traj_id'], event_trajectory_ids)]
-
-        event_segment_ids = truth_ids_dict['segment_ids']
-        segments_array = np.array(self._segments)
-        result.segments = segments_array[np.isin(segments_array['segment_id'], event_segment_ids)]
-
+        with self.profiler.Timer('hits'):
+            if self._hit_cache is not None:
+                misses = self._hit_cache.misses + self._backtrack_cache.misses
+                result.hits = self._hit_cache.Read(hit_start_index, hit_stop_index)
+                result.backtracked_hits = self._backtrack_cache.Read(hit_start_index, hit_stop_index)
+                self.profiler.Count('block_cache_misses',
+                                    self._hit_cache.misses + self._backtrack_cache.misses - misses)
+            else:
+                result.hits = self._hits[hit_start_index:hit_stop_index]
+                result.backtracked_hits = self._backtracked_hits[hit_start_index:hit_stop_index]
+
+        with self.profiler.Timer('truth'):
+            if self._truth_index is not None:
+                truth_ids_dict = {
+                    'segment_ids': self._truth_index.SegmentRows(result.event_id),
+                    'trajectory_ids': self._truth_index.TrajectoryRows(result.event_id),
+                }
+            else:
+                truth_ids_dict = self.GetEventTruthFromHits(result.backtracked_hits, 
+                                                            self._segments, 
+                                                            self._trajectories)
+            if 'segments' in truth_ids_dict:
+                result.trajectories = truth_ids_dict['trajectories']
+                result.segments = truth_ids_dict['segments']
+            else:
+                result.trajectories = _read_region(self._trajectories,
+                                                   truth_ids_dict['trajectory_ids'],
+                                                   'traj_id')
+                result.segments = _read_region(self._segments,
+                                               truth_ids_dict['segment_ids'],
+                                               'segment_id')
+
+        if self.profiler.enabled:
+            self.profiler.Count('hits', len(result.hits))
+            self.profiler.Count('contributors', int(np.count_nonzero(result.backtracked_hits['fraction'])))
+            self.profiler.Count('segments', len(result.segments))
+            self.profiler.Count('bytes_read', result.hits.nbytes + result.backtracked_hits.nbytes +
+                                result.segments.nbytes + result.trajectories.nbytes)
 
         result.interactions = self._interactions
+
+        with self.profiler.Timer('flashes'):
+            result.flashes = self.GetEventFlashes(result.event_id)
+        self.profiler.Count('flashes', len(result.flashes))
         
         return result  
  
 
 
+    def GetEventFlashes(self, event_index):
+        '''
+        Return the InputFlashes matched to a charge event, or an empty list
+        when the file has no light data (or flashes are not read).
+        '''
+        if self._flash_reader is None:
+            return []
+        if self._flash_matches is not None:
+            time_index, starts, stops = self._flash_matches
+            flash_indices = time_index.Flashes(starts[event_index], stops[event_index])
+        else:
+            start, stop = self._light_regions[event_index]
+            if stop <= start:
+                return []
+            flash_indices = np.unique(self._light_refs[start:stop][:, 1])
+        return self._flash_reader.GetFlashes(flash_indices)
+
     def EventDump(self, input_event):
-        print('-----------EVENT DUMP-----------------')
-        print('Event ID {}'.format(input_event.event_id))
-        print('Event t0 {}'.format(input_event.t0))
-        print('Event hit indices (start, stop):', input_event.hit_indices)
-        print('Backtracked hits len:', len(input_event.backtracked_hits))
-        print('hits shape:', input_event.hits.shape)
-        print('segments in this event:', len(input_event.segments))
-        print('trajectories in this event:', len(input_event.trajectories))
-        print('interactions in this event:', len(input_event.interactions))
-
-
-# class FlowFlashReader:
-    
-#     def __init__(self, parser_run_config, input_files=None):
-#         self._input_files = input_files
-#         if not isinstance(input_files, str):
-#             raise TypeError('Input file must be a str type')
-        
-#         self._flash_t0s = None
-#         self._flash_ids = None
-#         self._hit_indices = None
-#         self._sipm_hits = None
-       
+        logger.debug('-----------EVENT DUMP-----------------')
+        logger.debug('File %d (%s)', input_event.file_index, input_event.file_name)
+        logger.debug('Event ID %s', input_event.event_id)
+        logger.debug('Event t0 %s', input_event.t0)
+        logger.debug('Event hit indices (start, stop): %s', input_event.hit_indices)
+        logger.debug('Backtracked hits len: %d', len(input_event.backtracked_hits))
+        logger.debug('hits shape: %s', input_event.hits.shape)
+        logger.debug('segments in this event: %d', len(input_event.segments))
+        logger.debug('trajectories in this event: %d', len(input_event.trajectories))
+        logger.debug('interactions in this event: %d', len(input_event.interactions))
+        logger.debug('flashes in this event: %d', len(input_event.flashes))
+
+
+class FlashTimeIndex:
+    '''
+    Interval index matching charge events to flashes by time. Flash times are
+    sorted once; the flashes within [t + window[0], t + window[1]] of each
+    event time t are then found with two searchsorted calls over all events,
+    so matching costs O((N + M) log M) for N events and M flashes.
+    '''
+
+    def __init__(self, flash_times):
+        flash_times = np.asarray(flash_times, dtype=np.float64)
+        self._order = np.argsort(flash_times, kind='stable')
+        self._sorted_times = flash_times[self._order]
+
+    def Match(self, event_times, window):
+        '''
+        Return the (start, stop) positions in the sorted flashes of the window
+        around each event time.
+        '''
+        event_times = np.asarray(event_times, dtype=np.float64)
+        starts = np.searchsorted(self._sorted_times, event_times + window[0], side='left')
+        stops = np.searchsorted(self._sorted_times, event_times + window[1], side='right')
+        return starts, np.maximum(stops, starts)
 
-#         if input_files:
-#             self.ReadFlash(input_files)
+    def Flashes(self, start, stop):
+        '''
+        Return the flash indices between two matched positions, in index order.
+        '''
+        return np.sort(self._order[start:stop])
 
-#     def __len__(self):
-#         if self._flash_ids is None: return 0
-#         return len(self._flash_ids)
 
-    
-#     def __iter__(self):
-#         for entry in range(len(self)):
-#             yield self.GetEvent(entry)
-
-#     def ReadFlash(self, input_files, verbose=False):
-#         flash_events_path = 'light/events/data'
-#         hits_ref_region = 'light/events/ref/light/sipm_hits/ref_region'
-#         sipm_hits = 'light/sipm_hits/data'
-#         flow_manager = h5flow.data.H5FlowDataManager(input_files, 'r')
-#         with h5py.File(input_files, 'r') as fin:
-#             flash_events = flow_manager[flash_events_path]
-#             self._flash_ids = flash_events['id']
-#             self._flash_t0s = flash_events['tai_ns'].flatten()
-#             self._hit_indices = flow_manager[hits_ref_region]
-#             self._sipm_hits = flow_manager[sipm_hits]
-    
-#     def GetFlash(self, event_index):
-        
-#         if event_index >= len(self._flash_ids):
-#             print('Entry {} is above allowed entry index ({})'.format(event_index, len(self._flash_ids)))
-#             print('Invalid read request (returning None)')
-#             return None
-        
-#         result = supera.Flash()
-#         result.id = self._flash_ids[event_index]
-#         result.time = self._flash_t0s[event_index*8]/1000. #TO DO: why are there 8 entries? (TPC times?) How to handle this?#  
+class InputFlash:
+    id = -1
+    time = -1
+    time_width = -1
+    pe_per_opdet = None
+
+
+class FlowFlashReader:
+    '''
+    Reads light events (flashes) and their SiPM hits from an ndlar_flow file.
+    The SiPM hits of a flash are found through the light/events ref_region,
+    and the hits of several flashes are read with a single region read.
+    '''
+
+    SIPM_HIT_FIELDS = ('sum', 'busy_ns')
+
+    def __init__(self, parser_run_config, input_file=None):
+        self._run_config = parser_run_config
+        self._file = None
+        self._flash_ids = None
+        self._flash_t0s = None
+        self._hit_indices = None
+        self._sipm_hits = None
+
+        if input_file:
+            self.ReadFlash(input_file)
+
+    def __len__(self):
+        if self._flash_ids is None: return 0
+        return len(self._flash_ids)
 
-#         hit_start_index = self._hit_indices[result.id][0]
-#         hit_stop_index  = self._hit_indices[result.id][1]
-#         sipm_hits = self._sipm_hits[hit_start_index:hit_stop_index]
-#         result.PEPerOpDet = cppyy.gbl.std.vector('double')() #Because c++ vectors are not correctly recognized as vectors here, other supera types seem fine
-#         for hit in sipm_hits:
-#             result.PEPerOpDet.push_back(hit['sum'])
-#         result.timeWidth = (sipm_hits['busy_ns'][len(sipm_hits)-1] - sipm_hits['busy_ns'][0])/1000. #check this, busy_ns is  timestamp of peak relative to trigger 
-#         return result  
+    def __iter__(self):
+        for entry in range(len(self)):
+            yield self.GetFlash(entry)
 
+    def ReadFlash(self, input_file, verbose=False):
+        '''
+        Attach to the light datasets of a file name or an already open h5py file.
+        '''
+        flash_events_path = 'light/events/data'
+        hits_ref_region = 'light/events/ref/light/sipm_hits/ref_region'
+        sipm_hits = 'light/sipm_hits/data'
+
+        if isinstance(input_file, str):
+            self.CloseFile()
+            self._file = h5py.File(input_file, 'r')
+            fin = self._file
+        else:
+            fin = input_file
+        flash_events = fin[flash_events_path]
+        self._flash_ids = flash_events['id']
+        # tai_ns holds one time per light ADC; the first one is the flash time
+        self._flash_t0s = flash_events['tai_ns'].reshape(len(self._flash_ids), -1)[:, 0]
+        self._hit_indices = fin[hits_ref_region][()]
+        self._sipm_hits = FieldProjection(fin[sipm_hits], self.SIPM_HIT_FIELDS)
+
+    def CloseFile(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+
+    def FlashTimes(self):
+        '''
+        Return the time of every flash in ns (tai_ns of the first light ADC).
+        '''
+        return self._flash_t0s
 
-#     def FlashDump(self, input_flash):
-#         print('-----------EVENT DUMP-----------------')
-#         print('Flash ID {}'.format(input_flash.id))
-#         print('Flash t0 us {}'.format(input_flash.time))
-#         print('Flash width in us {}'.format(input_flash.timeWidth))
+    def GetFlash(self, flash_index):
 
+        if flash_index >= len(self):
+            logger.error('Entry %d is above allowed entry index (%d)', flash_index, len(self))
+            logger.error('Invalid read request (returning None)')
+            return None
+        return self.GetFlashes([flash_index])[0]
 
+    def GetFlashes(self, flash_indices):
+        '''
+        Return an InputFlash for each of the given flash indices. The SiPM hits
+        of all of them are read at once, spanning their non-empty ref_region rows
+        (a flash without SiPM hits has the region (0, 0)).
+        '''
+        flash_indices = np.asarray(flash_indices, dtype=np.int64)
+        if len(flash_indices) == 0:
+            return []
+        regions = self._hit_indices[flash_indices]
+        non_empty = regions['stop'] > regions['start']
+        region_start, region_stop = 0, 0
+        if non_empty.any():
+            region_start = int(regions['start'][non_empty].min())
+            region_stop = int(regions['stop'][non_empty].max())
+        sipm_hits = self._sipm_hits[region_start:region_stop]
+        pe = sipm_hits['sum'].astype(np.float64)
+        busy_ns = sipm_hits['busy_ns']
+
+        flashes = []
+        for flash_index, (start, stop) in zip(flash_indices.tolist(), regions.tolist()):
+            result = InputFlash()
+            result.id = int(self._flash_ids[flash_index])
+            result.time = self._flash_t0s[flash_index]/1000.
+            if stop <= start:
+                start, stop = region_start, region_start
+            start -= region_start
+            stop -= region_start
+            result.pe_per_opdet = pe[start:stop]
+            #check this, busy_ns is  timestamp of peak relative to trigger 
+            result.time_width = (busy_ns[stop-1] - busy_ns[start])/1000. if stop > start else 0.
+            flashes.append(result)
+        return flashes
+
+    def FlashDump(self, input_flash):
+        logger.debug('-----------FLASH DUMP-----------------')
+        logger.debug('Flash ID %s', input_flash.id)
+        logger.debug('Flash t0 us %s', input_flash.time)
+        logger.debug('Flash width in us %s', input_flash.time_width)
+        logger.debug('SiPM hits: %d', len(input_flash.pe_per_opdet))
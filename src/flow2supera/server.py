@@ -0,0 +1,227 @@
+import os
+import binascii
+import errno
+import socket
+import stat
+import time
+import traceback
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+import flow2supera
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+# Default address: a unix socket in the working directory
+DEFAULT_ADDRESS = 'flow2supera.sock'
+
+# Environment variable holding the key shared by the server and its clients.
+# Without it, a unix socket server writes a random key to a private file next
+# to the socket and its clients read it from there.
+AUTHKEY_ENV = 'FLOW2SUPERA_AUTHKEY'
+
+# run_supera arguments that are paths, made absolute by the client because the
+# server may run in another directory
+PATH_ARGUMENTS = ('out_file', 'in_file', 'save_log', 'truth_index_dir', 'column_store_dir', 'profile_file')
+
+
+def parse_address(address):
+    '''
+    Return a multiprocessing address: "host:port" for a TCP socket, anything
+    else is the path of a unix socket.
+    '''
+    if isinstance(address, tuple):
+        return address
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return (host, int(port))
+    return os.path.abspath(address)
+
+
+def key_file_name(address):
+    '''
+    File holding the generated key of a unix socket server.
+    '''
+    return address + '.key'
+
+
+def get_authkey(address, authkey=None):
+    '''
+    Return the key for address: authkey or $FLOW2SUPERA_AUTHKEY if set,
+    otherwise (unix sockets only) the key in the file written by the server.
+    Connections are authenticated with it before any job is unpickled, so a
+    TCP address requires an explicit key.
+    '''
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV) or None
+    if authkey is not None:
+        if isinstance(authkey, str):
+            authkey = authkey.encode()
+        return authkey
+
+    if isinstance(address, tuple):
+        raise ValueError('A TCP address needs an explicit key: set %s' % AUTHKEY_ENV)
+
+    key_file = key_file_name(address)
+    if not os.path.isfile(key_file):
+        raise ValueError('No key for %s: set %s or start the server first' % (address, AUTHKEY_ENV))
+    with open(key_file, 'rb') as f:
+        return f.read().strip()
+
+
+def write_key_file(address, authkey):
+    '''
+    Write authkey to the key file of a unix socket, readable by its owner only,
+    replacing the file of an earlier server, and return the file name.
+    '''
+    key_file = key_file_name(address)
+    if os.path.exists(key_file):
+        os.remove(key_file)
+    fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+    return key_file
+
+
+def remove_stale_socket(address):
+    '''
+    Remove the socket file of a unix socket server that is no longer running
+    (one that was killed leaves it behind). A socket that still accepts
+    connections raises OSError instead.
+    '''
+    if isinstance(address, tuple) or not os.path.exists(address):
+        return
+    if not stat.S_ISSOCK(os.stat(address).st_mode):
+        return
+    probe = socket.socket(socket.AF_UNIX)
+    try:
+        probe.connect(address)
+    except ConnectionRefusedError:
+        logger.warning('Removing the stale socket %s', address)
+        os.remove(address)
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, 'A server is already running at %s' % address)
+
+
+class ConversionServer:
+    '''
+    Long-lived conversion process. One configured SuperaDriver per
+    configuration is kept warm (ROOT, the compiled helpers and the detector
+    geometry are loaded once), and the run_supera jobs sent by submit_job are
+    run one at a time with it, so a job only pays for opening its files.
+    '''
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None, config_keys=()):
+        self._address = parse_address(address)
+        self._authkey = authkey or os.environ.get(AUTHKEY_ENV) or None
+        if self._authkey is None and isinstance(self._address, tuple):
+            raise ValueError('A TCP address needs an explicit key: set %s' % AUTHKEY_ENV)
+        self._drivers = {}
+        for config_key in config_keys:
+            self.Driver(config_key)
+
+    def Driver(self, config_key):
+        '''
+        Return the driver of a configuration, configuring it on first use.
+        '''
+        if not config_key in self._drivers:
+            start_time = time.time()
+            self._drivers[config_key] = flow2supera.utils.get_flow2supera(config_key)
+            logger.info('Configured %s in %.2e seconds', config_key, time.time() - start_time)
+        return self._drivers[config_key]
+
+    def Run(self, job):
+        '''
+        Run one job (a dict of run_supera arguments) and return its duration.
+        '''
+        driver = self.Driver(job.get('config_key', ''))
+        start_time = time.time()
+        flow2supera.utils.run_supera(driver=driver, **job)
+        return time.time() - start_time
+
+    def Serve(self):
+        '''
+        Accept jobs until a client sends stop_server.
+        '''
+        remove_stale_socket(self._address)
+        if self._authkey is None:
+            authkey = binascii.hexlify(os.urandom(32))
+        else:
+            authkey = get_authkey(self._address, self._authkey)
+        # The key file is only written once the address is ours, and only the
+        # file written here is removed, so a server that fails to start does
+        # not touch the key of the one running at the address
+        with Listener(self._address, authkey=authkey) as listener:
+            key_file = None
+            if self._authkey is None:
+                key_file = write_key_file(self._address, authkey)
+            try:
+                self._Serve(listener)
+            finally:
+                if key_file:
+                    os.remove(key_file)
+        logger.info('Server stopped')
+
+    def _Serve(self, listener):
+        logger.info('Serving conversion jobs at %s', listener.address)
+        while True:
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, EOFError, OSError) as error:
+                logger.warning('Rejected a connection: %s', error)
+                continue
+            with connection:
+                try:
+                    job = connection.recv()
+                except (EOFError, OSError):
+                    continue
+                if job is None:
+                    connection.send(dict(status='stopped'))
+                    return
+                logger.info('Job: %s -> %s', job.get('in_file'), job.get('out_file'))
+                try:
+                    reply = dict(status='done', seconds=self.Run(job))
+                except Exception:
+                    logger.error('Job failed:\n%s', traceback.format_exc())
+                    reply = dict(status='failed', error=traceback.format_exc())
+                try:
+                    connection.send(reply)
+                except OSError:
+                    logger.warning('The client of the last job disconnected')
+
+
+def submit_job(address=DEFAULT_ADDRESS, authkey=None, **job):
+    '''
+    Send a run_supera job (its keyword arguments) to a ConversionServer, wait
+    for it to finish and return its duration on the server. A job that fails
+    raises RuntimeError with the server's traceback.
+    '''
+    for key in PATH_ARGUMENTS:
+        if not job.get(key):
+            continue
+        if isinstance(job[key], str):
+            job[key] = os.path.abspath(job[key])
+        else:
+            job[key] = [os.path.abspath(path) for path in job[key]]
+    if os.path.isfile(job.get('config_key', '')):
+        job['config_key'] = os.path.abspath(job['config_key'])
+
+    address = parse_address(address)
+    with Client(address, authkey=get_authkey(address, authkey)) as connection:
+        connection.send(job)
+        reply = connection.recv()
+    if reply['status'] == 'failed':
+        raise RuntimeError('Conversion job failed on the server:\n' + reply['error'])
+    return reply['seconds']
+
+
+def stop_server(address=DEFAULT_ADDRESS, authkey=None):
+    '''
+    Ask a ConversionServer to stop after its current job.
+    '''
+    address = parse_address(address)
+    with Client(address, authkey=get_authkey(address, authkey)) as connection:
+        connection.send(None)
+        connection.recv()
@@ -1,14 +1,30 @@
 import sys, os
 import h5py
-import h5flow
 import numpy as np
 import time
+import logging
 import flow2supera
 import argparse
-import ROOT
-from edep2supera.utils import get_iomanager, larcv_meta, larcv_particle
+import json
+import multiprocessing
+import queue
+import shutil
+import tempfile
+import threading
 #from LarpixParser import event_parser as EventParser
-from larcv import larcv
+from .log import get_logger, setup_logging
+
+logger = get_logger(__name__)
+
+# Products written for each entry, as (type, producer) pairs
+LARCV_PRODUCTS = [('sparse3d', 'pcluster'),
+                  ('sparse3d', 'packets'),
+                  ('sparse3d', 'pcluster_semantics'),
+                  ('cluster3d', 'pcluster'),
+                  ('cluster3d', 'pcluster_dedx'),
+                  ('particle', 'pcluster'),
+                  ('trigger', 'base'),
+                  ('opflash', 'sipm_hits')]
 
 def get_flow2supera(config_key):
 
@@ -50,16 +66,16 @@ def log_supera_integrity_check(data, driver, log, verbose=False):
     unass_sum  = np.sum([vox.value() for vox in label._unassociated_voxels.as_vector()])
     
     if verbose:
-        print('  Raw image    :',voxels_num,'voxels with the sum',voxels_sum)
-        print('  Packets      :',pcloud_num,'packets with the sum',pcloud_sum)
-        print('  Input cluster:',input_sum)
-        print('  Input unass. :',input_unass)
-        print('  Label image  :',energy_num,'voxels with the sum',energy_sum)
-        print('  Label cluster:',cluster_sum)
-        print('  Unassociated :',unass_sum)
-        print('  Label image - (Cluster sum + Unassociated)',energy_sum - (cluster_sum + unass_sum))
-        print('  Label image - Raw image',energy_sum - voxels_sum)
-        print('  Packets - Raw image',pcloud_sum - voxels_sum)
+        logger.debug('  Raw image    : %d voxels with the sum %s', voxels_num, voxels_sum)
+        logger.debug('  Packets      : %d packets with the sum %s', pcloud_num, pcloud_sum)
+        logger.debug('  Input cluster: %s', input_sum)
+        logger.debug('  Input unass. : %s', input_unass)
+        logger.debug('  Label image  : %d voxels with the sum %s', energy_num, energy_sum)
+        logger.debug('  Label cluster: %s', cluster_sum)
+        logger.debug('  Unassociated : %s', unass_sum)
+        logger.debug('  Label image - (Cluster sum + Unassociated) %s', energy_sum - (cluster_sum + unass_sum))
+        logger.debug('  Label image - Raw image %s', energy_sum - voxels_sum)
+        logger.debug('  Packets - Raw image %s', pcloud_sum - voxels_sum)
 
     log['raw_image_sum'].append(voxels_sum)
     log['raw_image_npx'].append(voxels_num)
@@ -72,16 +88,734 @@ def log_supera_integrity_check(data, driver, log, verbose=False):
     log['out_cluster_sum'].append(cluster_sum)
     log['out_unass_sum'].append(unass_sum)
     
-# def larcv_flash(f):
+# Builds LArCV products straight from the label's voxel sets, skipping the
+# round trip through shared std::vectors and larcv.as_event_* copies.
+_LARCV_STORE_CODE = '''
+#ifndef FLOW2SUPERA_LARCV_STORE
+#define FLOW2SUPERA_LARCV_STORE
+namespace flow2supera {
+template <class VoxelSetT>
+larcv::VoxelSet ToLArCVVoxels(const VoxelSetT& voxels)
+{
+    larcv::VoxelSet larcv_voxels;
+    larcv_voxels.reserve(voxels.size());
+    for (auto const& voxel : voxels.as_vector())
+        larcv_voxels.emplace(voxel.id(), voxel.value(), false);
+    return larcv_voxels;
+}
+
+template <class VoxelSetT>
+void StoreSparse3D(larcv::EventSparseTensor3D& tensor,
+                   const larcv::Voxel3DMeta& meta,
+                   const VoxelSetT& voxels)
+{
+    tensor.emplace(ToLArCVVoxels(voxels), meta);
+}
+
+// Same layout as FillClustersEnergy/FillClustersdEdX: one cluster per
+// particle followed by the unassociated voxels.
+template <class LabelT>
+void StoreCluster3D(larcv::EventClusterVoxel3D& clusters,
+                    const larcv::Voxel3DMeta& meta,
+                    const LabelT& label,
+                    const bool dedx)
+{
+    std::vector<larcv::VoxelSet> voxel_sets;
+    voxel_sets.reserve(label._particles.size() + 1);
+    for (auto const& particle : label._particles)
+        voxel_sets.push_back(ToLArCVVoxels(dedx ? particle.dedx : particle.energy));
+    voxel_sets.push_back(ToLArCVVoxels(label._unassociated_voxels));
+    larcv::VoxelSetArray larcv_clusters;
+    larcv_clusters.emplace(std::move(voxel_sets));
+    clusters.emplace(std::move(larcv_clusters), meta);
+}
+
+// One copy of a whole NumPy column instead of a push_back per element
+std::vector<double> ToDoubleVector(const double* values, const size_t size)
+{
+    return std::vector<double>(values, values + size);
+}
+}
+#endif
+'''
+_larcv_store_declared = False
+
+def _larcv_store():
+    '''
+    Return the namespace of the LArCV store helpers, compiling them on first use.
+    '''
+    global _larcv_store_declared
+    import ROOT
+    if not _larcv_store_declared:
+        ROOT.gInterpreter.Declare(_LARCV_STORE_CODE)
+        _larcv_store_declared = True
+    return ROOT.flow2supera
+
+def store_larcv_tensors(writer, driver, meta):
+    '''
+    Fill the sparse3d and cluster3d products of the current entry directly from
+    the label's voxel sets.
+    '''
+    result = driver.Label()
+    store = _larcv_store()
+
+    store.StoreSparse3D(writer.get_data("sparse3d", "pcluster"), meta, result._energies)
+    store.StoreSparse3D(writer.get_data("sparse3d", "packets"), meta,
+                        driver.Meta().edep2voxelset(driver._edeps_all))
+    store.StoreSparse3D(writer.get_data("sparse3d", "pcluster_semantics"), meta,
+                        result._semanticVoxels)
+    store.StoreCluster3D(writer.get_data("cluster3d", "pcluster"), meta, result, False)
+    store.StoreCluster3D(writer.get_data("cluster3d", "pcluster_dedx"), meta, result, True)
+
+def larcv_flash(f):
+    '''
+    Convert an InputFlash into a larcv.Flash, filling PEPerOpDet in one copy.
+    '''
+    from larcv import larcv
+    larf=larcv.Flash()
+
+    larf.id              (int(f.id))
+    larf.time            (f.time)
+    larf.timeWidth       (f.time_width)
+    pe = np.ascontiguousarray(f.pe_per_opdet, dtype=np.float64)
+    larf.PEPerOpDet      (_larcv_store().ToDoubleVector(pe, len(pe)))
+    return larf
+
+def log_file_name(save_log):
+    '''
+    Name of the npz integrity log: save_log if it names an .npz file,
+    log_flow2supera.npz in the working directory otherwise.
+    '''
+    if isinstance(save_log, str) and save_log.endswith('.npz'):
+        return save_log
+    return 'log_flow2supera.npz'
+
+def merge_logs(in_files, out_file):
+    '''
+    Concatenate npz integrity logs key by key, in the order given.
+    '''
+    log_data = dict()
+    for in_file in in_files:
+        if not os.path.isfile(in_file):
+            logger.warning('Missing shard log %s', in_file)
+            continue
+        with np.load(in_file) as data:
+            for key in data.files:
+                log_data.setdefault(key, []).append(data[key])
+    np.savez(out_file, **{key: np.concatenate(values) for key, values in log_data.items()})
+
+def shard_file_name(out_file, shard_index):
+    '''
+    Name of the per-worker output written before the shards are merged.
+    '''
+    base, ext = os.path.splitext(out_file)
+    return '%s.shard%03d%s' % (base, shard_index, ext)
+
+def merge_larcv(in_files, out_file):
+    '''
+    Concatenate LArCV files entry by entry, in the order given, into out_file.
+    Every product written by run_supera is read so that it is carried over.
+    '''
+    from larcv import larcv
+    io = larcv.IOManager(larcv.IOManager.kBOTH)
+    for in_file in in_files:
+        io.add_in_file(in_file)
+    io.set_out_file(out_file)
+    io.initialize()
+    for entry in range(io.get_n_entries()):
+        io.read_entry(entry)
+        for product_type, producer in LARCV_PRODUCTS:
+            io.get_data(product_type, producer)
+        io.save_entry()
+    io.finalize()
+
+class LArCVWriter:
+    '''
+    Writes each entry to a LArCV ROOT file through the LArCV IOManager.
+    '''
+
+    def __init__(self, out_file):
+        from larcv import larcv
+        from edep2supera.utils import get_iomanager
+        # Let the ROOT I/O run without holding the GIL so an EntrySaver can overlap it
+        larcv.IOManager.save_entry.__release_gil__ = True
+        self._io = get_iomanager(out_file)
+
+    def Store(self, driver, input_data):
+        '''
+        Fill every product of the current entry from the driver's label.
+        '''
+        from edep2supera.utils import larcv_meta, larcv_particle
+        result = driver.Label()
+        meta   = larcv_meta(driver.Meta())
+
+        store_larcv_tensors(self._io, driver, meta)
+
+        particle = self._io.get_data("particle", "pcluster")
+        logger.debug('len particles %d', len(result._particles))
+        for p in result._particles:
+            if not p.valid:
+                continue
+            larp = larcv_particle(p)
+            particle.append(larp)
+            
+        #propagating trigger info
+        trigger = self._io.get_data("trigger", "base")
+        trigger.id(int(input_data.event_id))  # fixme: this will need to be different for real data?
+        trigger.time_s(int(input_data.t0))
+        trigger.time_ns(int(1e9 * (input_data.t0 - trigger.time_s())))
+
+        # Flashes go into the same entry (empty when the input has no light data)
+        flash = self._io.get_data("opflash", "sipm_hits")
+        for input_flash in input_data.flashes or []:
+            flash.append(larcv_flash(input_flash))
         
-#     larf=larcv.Flash()
-    
-#     larf.id              (int(f.id))
-#     larf.time            (f.time)
-#     larf.timeWidth       (f.timeWidth)
-#     larf.PEPerOpDet      (f.PEPerOpDet)
-#     # 
-#     return larf
+        # TODO fill the run ID 
+        # The subrun identifies the input file within a multi-file run
+        self._io.set_id(0, int(input_data.file_index), int(input_data.event_id))
+
+    def Save(self):
+        self._io.save_entry()
+
+    def Finalize(self):
+        self._io.finalize()
+
+    @staticmethod
+    def Merge(in_files, out_file):
+        merge_larcv(in_files, out_file)
+
+class H5Writer:
+    '''
+    Writes each entry to an HDF5 file as flat, chunked and compressed columnar
+    datasets. Every product group holds a ref_region dataset with one
+    (start, stop) row per entry, so any entry can be sliced without decoding others:
+
+        events                          event_id, run, subrun, t0 and voxel meta per entry
+        sparse3d/<name>/voxels          (id, value) of every voxel
+        cluster3d/<name>/voxels         (id, value) of every clustered voxel
+        cluster3d/<name>/clusters       (start, stop) of each cluster in voxels
+        particle/pcluster/data          one row per valid particle
+        opflash/sipm_hits/flashes       id, time, time width and (start, stop) in pe of each flash
+        opflash/sipm_hits/pe            PE of every SiPM hit of every flash
+
+    Chunks hold about CHUNK_BYTES of rows, so one-row-per-entry tables get
+    small chunks too. Rows are buffered per dataset and written a whole chunk
+    at a time, so a compressed chunk is never read back to be extended; the
+    rest is written by Finalize().
+    '''
+
+    CHUNK_BYTES = 1 << 20
+
+    REGION_DTYPE = np.dtype([('start', 'i8'), ('stop', 'i8')])
+    VOXEL_DTYPE = np.dtype([('id', 'u8'), ('value', 'f4')])
+    EVENT_DTYPE = np.dtype([('event_id', 'i8'), ('run', 'i4'), ('subrun', 'i4'), ('t0', 'f8'),
+                            ('min', 'f8', (3,)), ('max', 'f8', (3,)), ('num_voxels', 'i8', (3,))])
+    PARTICLE_DTYPE = np.dtype([('id', 'i8'), ('interaction_id', 'i8'), ('trackid', 'i8'),
+                               ('pdg', 'i4'), ('type', 'i4'),
+                               ('parent_trackid', 'i8'), ('parent_pdg', 'i4'),
+                               ('ancestor_trackid', 'i8'), ('ancestor_pdg', 'i4'),
+                               ('energy_init', 'f8'), ('energy_deposit', 'f8'),
+                               ('momentum', 'f8', (3,)),
+                               ('vtx', 'f8', (4,)), ('end_pt', 'f8', (4,)),
+                               ('num_voxels', 'i8')])
+    FLASH_DTYPE = np.dtype([('id', 'i8'), ('time', 'f8'), ('time_width', 'f8'),
+                            ('start', 'i8'), ('stop', 'i8')])
+
+    def __init__(self, out_file):
+        import ROOT
+        self._file = h5py.File(out_file, 'w')
+        self._id_v = ROOT.std.vector("unsigned long")()
+        self._value_v = ROOT.std.vector("float")()
+        self._id_vv = ROOT.std.vector("std::vector<unsigned long>")()
+        self._value_vv = ROOT.std.vector("std::vector<float>")()
+        # Per dataset: [buffered row arrays, number of buffered rows, target]
+        self._pending = {}
+        self._num_rows = {}
+
+    @classmethod
+    def _ChunkRows(cls, dtype):
+        return max(cls.CHUNK_BYTES // dtype.itemsize, 1)
+
+    @classmethod
+    def _Write(cls, h5_file, path, rows, target=None):
+        '''
+        Append rows to a resizable dataset, creating it on first use. Region
+        datasets record the sibling dataset they index in a 'target' attribute.
+        '''
+        if path not in h5_file:
+            h5_file.create_dataset(path, shape=(0,), maxshape=(None,), dtype=rows.dtype,
+                                   chunks=(cls._ChunkRows(rows.dtype),), compression='gzip',
+                                   compression_opts=4, shuffle=True)
+            if target is not None:
+                h5_file[path].attrs['target'] = target
+        dataset = h5_file[path]
+        start = len(dataset)
+        dataset.resize((start + len(rows),))
+        dataset[start:] = rows
+
+    def _Append(self, path, rows, target=None):
+        '''
+        Buffer rows for a dataset and write every full chunk of buffered rows.
+        Returns the (start, stop) region the rows occupy in the dataset.
+        '''
+        if not path in self._pending:
+            self._pending[path] = [[], 0, target]
+            self._num_rows[path] = 0
+        pending = self._pending[path]
+        pending[0].append(rows)
+        pending[1] += len(rows)
+        start = self._num_rows[path]
+        self._num_rows[path] += len(rows)
+        if pending[1] >= self._ChunkRows(rows.dtype):
+            self._Flush(path, full_chunks_only=True)
+        return start, start + len(rows)
+
+    def _Flush(self, path, full_chunks_only=False):
+        buffered, num_buffered, target = self._pending[path]
+        rows = np.concatenate(buffered) if len(buffered) > 1 else buffered[0]
+        num_write = num_buffered
+        if full_chunks_only:
+            chunk_rows = self._ChunkRows(rows.dtype)
+            num_write -= num_buffered % chunk_rows
+        self._Write(self._file, path, rows[:num_write], target)
+        rest = rows[num_write:]
+        self._pending[path] = [[rest], len(rest), target]
+
+    def _Region(self, path, start, stop, target):
+        region = np.array([(start, stop)], dtype=self.REGION_DTYPE)
+        self._Append(path, region, target)
+
+    def _NumRows(self, path):
+        return self._num_rows.get(path, 0)
+
+    def _VoxelRows(self):
+        rows = np.empty(self._id_v.size(), dtype=self.VOXEL_DTYPE)
+        rows['id'] = np.asarray(self._id_v)
+        rows['value'] = np.asarray(self._value_v)
+        return rows
+
+    def _StoreSparse3D(self, name):
+        start, stop = self._Append('sparse3d/%s/voxels' % name, self._VoxelRows())
+        self._Region('sparse3d/%s/ref_region' % name, start, stop, 'voxels')
+
+    def _StoreCluster3D(self, name):
+        clusters = np.empty(self._id_vv.size(), dtype=self.REGION_DTYPE)
+        voxels = []
+        num_voxels = self._NumRows('cluster3d/%s/voxels' % name)
+        for cluster_index in range(self._id_vv.size()):
+            cluster = np.empty(self._id_vv[cluster_index].size(), dtype=self.VOXEL_DTYPE)
+            cluster['id'] = np.asarray(self._id_vv[cluster_index])
+            cluster['value'] = np.asarray(self._value_vv[cluster_index])
+            clusters[cluster_index] = (num_voxels, num_voxels + len(cluster))
+            num_voxels += len(cluster)
+            voxels.append(cluster)
+        self._Append('cluster3d/%s/voxels' % name,
+                     np.concatenate(voxels) if voxels else np.empty(0, dtype=self.VOXEL_DTYPE))
+        start, stop = self._Append('cluster3d/%s/clusters' % name, clusters, 'voxels')
+        self._Region('cluster3d/%s/ref_region' % name, start, stop, 'clusters')
+
+    def _StoreParticles(self, result):
+        particles = [label for label in result._particles if label.valid]
+        rows = np.zeros(len(particles), dtype=self.PARTICLE_DTYPE)
+        for row, label in zip(rows, particles):
+            part = label.part
+            row['id'] = part.id
+            row['interaction_id'] = part.interaction_id
+            row['trackid'] = part.trackid
+            row['pdg'] = part.pdg
+            row['type'] = int(part.type)
+            row['parent_trackid'] = part.parent_trackid
+            row['parent_pdg'] = part.parent_pdg
+            row['ancestor_trackid'] = part.ancestor_trackid
+            row['ancestor_pdg'] = part.ancestor_pdg
+            row['energy_init'] = part.energy_init
+            row['energy_deposit'] = label.energy.sum()
+            row['momentum'] = (part.px, part.py, part.pz)
+            row['vtx'] = (part.vtx.pos.x, part.vtx.pos.y, part.vtx.pos.z, part.vtx.time)
+            row['end_pt'] = (part.end_pt.pos.x, part.end_pt.pos.y, part.end_pt.pos.z, part.end_pt.time)
+            row['num_voxels'] = label.energy.size()
+        start, stop = self._Append('particle/pcluster/data', rows)
+        self._Region('particle/pcluster/ref_region', start, stop, 'data')
+
+    def _StoreFlashes(self, flashes):
+        rows = np.zeros(len(flashes), dtype=self.FLASH_DTYPE)
+        num_pe = self._NumRows('opflash/sipm_hits/pe')
+        for row, flash in zip(rows, flashes):
+            row['id'] = flash.id
+            row['time'] = flash.time
+            row['time_width'] = flash.time_width
+            row['start'] = num_pe
+            num_pe += len(flash.pe_per_opdet)
+            row['stop'] = num_pe
+        pe = [np.asarray(flash.pe_per_opdet, dtype=np.float64) for flash in flashes]
+        self._Append('opflash/sipm_hits/pe',
+                     np.concatenate(pe) if pe else np.empty(0, dtype=np.float64))
+        start, stop = self._Append('opflash/sipm_hits/flashes', rows, 'pe')
+        self._Region('opflash/sipm_hits/ref_region', start, stop, 'flashes')
+
+    def Store(self, driver, input_data):
+        '''
+        Fill every product of the current entry from the driver's label.
+        '''
+        result = driver.Label()
+        meta = driver.Meta()
+
+        result.FillTensorEnergy(self._id_v, self._value_v)
+        self._StoreSparse3D('pcluster')
+        meta.edep2voxelset(driver._edeps_all).fill_std_vectors(self._id_v, self._value_v)
+        self._StoreSparse3D('packets')
+        result.FillTensorSemantic(self._id_v, self._value_v)
+        self._StoreSparse3D('pcluster_semantics')
+
+        result.FillClustersEnergy(self._id_vv, self._value_vv)
+        self._StoreCluster3D('pcluster')
+        result.FillClustersdEdX(self._id_vv, self._value_vv)
+        self._StoreCluster3D('pcluster_dedx')
+
+        self._StoreParticles(result)
+        self._StoreFlashes(input_data.flashes or [])
+
+        event = np.zeros(1, dtype=self.EVENT_DTYPE)
+        event['event_id'] = input_data.event_id
+        event['subrun'] = input_data.file_index
+        event['t0'] = input_data.t0
+        event['min'] = (meta.min_x(), meta.min_y(), meta.min_z())
+        event['max'] = (meta.max_x(), meta.max_y(), meta.max_z())
+        event['num_voxels'] = (meta.num_voxel_x(), meta.num_voxel_y(), meta.num_voxel_z())
+        self._Append('events', event)
+
+    def Save(self):
+        pass
+
+    def Finalize(self):
+        for path in self._pending:
+            self._Flush(path)
+        self._pending = {}
+        self._file.close()
+
+    @classmethod
+    def Merge(cls, in_files, out_file):
+        '''
+        Concatenate HDF5 outputs in the order given, shifting every region by
+        the number of rows its target already holds in out_file.
+        '''
+        with h5py.File(out_file, 'w') as fout:
+            for in_file in in_files:
+                with h5py.File(in_file, 'r') as fin:
+                    paths = []
+                    fin.visititems(lambda path, item: paths.append(path)
+                                   if isinstance(item, h5py.Dataset) else None)
+                    offsets = {path: len(fout[path]) if path in fout else 0 for path in paths}
+                    for path in paths:
+                        target = fin[path].attrs.get('target', None)
+                        chunk_rows = cls._ChunkRows(fin[path].dtype)
+                        for start in range(0, max(len(fin[path]), 1), chunk_rows):
+                            rows = fin[path][start:start + chunk_rows]
+                            if target is not None:
+                                target_path = path.rsplit('/', 1)[0] + '/' + target
+                                rows['start'] += offsets[target_path]
+                                rows['stop'] += offsets[target_path]
+                            cls._Write(fout, path, rows, target)
+
+WRITERS = {'larcv': LArCVWriter, 'hdf5': H5Writer}
+
+def get_writer(out_file, output_format='larcv'):
+    '''
+    Return the writer registered under output_format in WRITERS.
+    '''
+    if not output_format in WRITERS:
+        raise ValueError('Unknown output format %s (options: %s)' % (output_format, list(WRITERS)))
+    return WRITERS[output_format](out_file)
+
+class Checkpoint:
+    '''
+    Records the committed parts of a checkpointed run in <out_file>.checkpoint.
+    Output is written in numbered parts; each part is finalized before it is
+    recorded, so an interrupted run resumes after the last committed entry and
+    only redoes the part that was in progress. The integrity log and profile
+    of a part are written next to it and recorded with it. Finish() merges
+    the parts and their logs.
+    '''
+
+    def __init__(self, out_file):
+        self._out_file = out_file
+        self._path = out_file + '.checkpoint'
+        self.parts = []
+        self.logs = []
+        self.profiles = []
+        self.next_entry = None
+        if os.path.isfile(self._path):
+            with open(self._path, 'r') as f:
+                state = json.load(f)
+            self.parts = state['parts']
+            self.logs = state.get('logs', [])
+            self.profiles = state.get('profiles', [])
+            self.next_entry = state['next_entry']
+
+    def PartFileName(self):
+        base, ext = os.path.splitext(self._out_file)
+        return '%s.part%03d%s' % (base, len(self.parts), ext)
+
+    @staticmethod
+    def PartLogName(part_file):
+        return os.path.splitext(part_file)[0] + '.log.npz'
+
+    @staticmethod
+    def PartProfileName(part_file):
+        return os.path.splitext(part_file)[0] + '.profile.csv'
+
+    def Commit(self, part_file, next_entry, log_file=None, profile_file=None):
+        self.parts.append(part_file)
+        if log_file:
+            self.logs.append(log_file)
+        if profile_file:
+            self.profiles.append(profile_file)
+        # Entries may come as numpy integers, which json does not serialize
+        next_entry = int(next_entry)
+        self.next_entry = next_entry
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(dict(parts=self.parts, logs=self.logs, profiles=self.profiles,
+                           next_entry=next_entry), f)
+        os.replace(temp_path, self._path)
+
+    def Finish(self, writer_class, log_file=None, profile_file=None):
+        if len(self.parts) == 1:
+            os.replace(self.parts[0], self._out_file)
+        else:
+            writer_class.Merge(self.parts, self._out_file)
+            for part_file in self.parts:
+                os.remove(part_file)
+        if log_file and self.logs:
+            merge_logs(self.logs, log_file)
+        if profile_file and self.profiles:
+            flow2supera.profiler.merge_logs(self.profiles, profile_file)
+        for side_file in self.logs + self.profiles:
+            if os.path.isfile(side_file):
+                os.remove(side_file)
+        os.remove(self._path)
+
+def select_entries(reader, num_skip=0, num_events=-1, selection=None):
+    '''
+    Return the entries to convert: the events passing the selection (a dict of
+    FlowReader.Select keyword arguments), after skipping num_skip of them and
+    keeping at most num_events (all if negative).
+    '''
+    entries = reader.Select(**(selection or {}))
+    entries = entries[num_skip:]
+    if num_events >= 0:
+        entries = entries[:num_events]
+    return entries
+
+# Fixed cost of converting an event, in units of the cost of one hit
+EVENT_COST_HITS = 100
+
+def balance_batches(costs, num_batches):
+    '''
+    Split entries, given by their estimated costs in order, into about
+    num_batches contiguous batches of equal total cost and return the batch
+    boundaries. Each cut is placed on the event boundary closest to its
+    target, and an event costing more than a batch is cut out into a batch of
+    its own (which can add a batch or two).
+    '''
+    costs = np.asarray(costs, dtype=np.float64)
+    cumulative = np.cumsum(costs)
+    targets = cumulative[-1] * np.arange(1, num_batches) / num_batches
+    positions = np.searchsorted(cumulative, targets, side='left')
+    before = np.where(positions > 0, cumulative[positions - 1], 0.)
+    cuts = np.where(targets - before < cumulative[positions] - targets, positions, positions + 1)
+    large = np.nonzero(costs > cumulative[-1] / num_batches)[0]
+    return np.unique(np.concatenate([[0], cuts, large, large + 1, [len(costs)]]))
+
+# Driver of a worker process, configured once and reused by all of its shards
+_worker_driver = None
+
+def _init_worker(config_key):
+    global _worker_driver
+    _worker_driver = get_flow2supera(config_key)
+
+def _run_shard(kwargs):
+    run_supera(driver=_worker_driver, **kwargs)
+    return kwargs['out_file']
+
+def run_supera_parallel(out_file='larcv.root',
+                        in_file='',
+                        num_events=-1,
+                        num_skip=0,
+                        workers=2,
+                        batches_per_worker=4,
+                        selection=None,
+                        **kwargs):
+    '''
+    Split the requested entries into contiguous shards of about equal cost,
+    estimated from the hit count of each event, and convert them in a pool of
+    worker processes that each keep one configured SuperaDriver. Shards are
+    handed out most expensive first, and their outputs are merged into
+    out_file in event order.
+    '''
+    in_files = [in_file] if isinstance(in_file, str) else list(in_file)
+    # The selection is resolved once here; shards receive explicit entries
+    reader = flow2supera.reader.FlowReader(None, in_files)
+    all_entries = select_entries(reader, num_skip, num_events, selection)
+    num_entries = len(all_entries)
+    if num_entries == 0:
+        logger.warning('No entries to convert')
+        return
+    costs = reader.HitCounts(all_entries) + EVENT_COST_HITS
+    bounds = balance_batches(costs, min(num_entries, workers * max(batches_per_worker, 1)))
+
+    # Export the shared column stores once so that the workers only attach
+    if kwargs.get('column_store_dir'):
+        for name in in_files:
+            flow2supera.reader.export_columns(name, kwargs['column_store_dir'])
+
+    # Every shard writes its own npz log, concatenated after the merge
+    log_file = log_file_name(kwargs['save_log']) if kwargs.get('save_log') else None
+    shard_logs = []
+
+    shards = []
+    shard_costs = []
+    shard_files = []
+    for shard_index, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        entries = all_entries[start:stop]
+        shard_out_file = shard_file_name(out_file, shard_index)
+        shard_kwargs = dict(kwargs)
+        shard_kwargs.update(out_file=shard_out_file,
+                            in_file=in_files,
+                            entries=entries,
+                            workers=1)
+        if kwargs.get('profile_file'):
+            shard_kwargs['profile_file'] = shard_file_name(kwargs['profile_file'], shard_index)
+        if log_file:
+            shard_kwargs['save_log'] = shard_file_name(log_file, shard_index)
+            shard_logs.append(shard_kwargs['save_log'])
+        # A shard of an earlier checkpointed run that already finished is kept as is
+        shard_done = (kwargs.get('checkpoint_interval', 0) > 0 and os.path.isfile(shard_out_file)
+                      and not os.path.isfile(shard_out_file + '.checkpoint'))
+        if not shard_done:
+            shards.append(shard_kwargs)
+            shard_costs.append(costs[start:stop].sum())
+        shard_files.append(shard_out_file)
+
+    logger.info('Converting %d entries in %d shards with %d workers (largest shard %.1f%% of the cost)',
+                num_entries, len(shards), workers,
+                100. * max(shard_costs, default=0) / max(sum(shard_costs), 1))
+    if shards:
+        # Most expensive first, so that a large shard does not start last
+        shards = [shards[index] for index in np.argsort(shard_costs, kind='stable')[::-1]]
+        # Build the truth index of each file once so that the shards only load
+        # it, in a temporary directory if no truth_index_dir keeps it
+        temp_index_dir = None
+        if kwargs.get('truth_index'):
+            index_dir = kwargs.get('truth_index_dir')
+            if not index_dir:
+                index_dir = temp_index_dir = tempfile.mkdtemp(prefix='flow2supera_truth_index_')
+            for name in in_files:
+                flow2supera.reader.build_truth_index(name, index_dir, kwargs.get('column_store_dir'))
+            for shard_kwargs in shards:
+                shard_kwargs['truth_index_dir'] = index_dir
+        # ROOT and cppyy state does not survive a fork, so start clean processes
+        context = multiprocessing.get_context('spawn')
+        try:
+            with context.Pool(min(workers, len(shards)), initializer=_init_worker,
+                              initargs=(kwargs.get('config_key', ''),)) as pool:
+                for _ in pool.imap_unordered(_run_shard, shards, chunksize=1):
+                    pass
+        finally:
+            if temp_index_dir:
+                shutil.rmtree(temp_index_dir, ignore_errors=True)
+
+    WRITERS[kwargs.get('output_format', 'larcv')].Merge(shard_files, out_file)
+    for shard_file in shard_files:
+        os.remove(shard_file)
+    if log_file:
+        merge_logs(shard_logs, log_file)
+        for shard_log in shard_logs:
+            if os.path.isfile(shard_log):
+                os.remove(shard_log)
+
+def read_events(reader, entries, profiler):
+    '''
+    Yield (entry, InputEvent) for the given entries, timing each read.
+    '''
+    for entry in entries:
+        with profiler.Timer('read'):
+            input_data = reader.GetEvent(entry)
+        yield entry, input_data
+
+class EventPrefetcher:
+    '''
+    Reads the InputEvents of the given entries on a background thread so that
+    HDF5 reads overlap with conversion. At most depth events are held at once.
+    Iterating yields (entry, InputEvent) pairs in entry order.
+    '''
+
+    def __init__(self, reader, entries, depth):
+        self._queue = queue.Queue(maxsize=depth)
+        self._thread = threading.Thread(target=self._Read, args=(reader, entries), daemon=True)
+        self._thread.start()
+
+    def _Read(self, reader, entries):
+        try:
+            for entry in entries:
+                self._queue.put((entry, reader.GetEvent(entry)))
+        except Exception as error:
+            self._queue.put(error)
+        self._queue.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def Depth(self):
+        return self._queue.qsize()
+
+class EntrySaver:
+    '''
+    Runs writer.Save() on a background thread so that writing one entry
+    overlaps with converting the next. The products of an entry must not be
+    refilled before Wait() returns.
+    '''
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._error = None
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._Save, daemon=True)
+        self._thread.start()
+
+    def _Save(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            try:
+                self._writer.Save()
+            except Exception as error:
+                self._error = error
+            self._queue.task_done()
+
+    def Save(self):
+        self._queue.put(True)
+
+    def Wait(self):
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def Depth(self):
+        return self._queue.unfinished_tasks
+
+    def Close(self):
+        self.Wait()
+        self._queue.put(None)
+        self._thread.join()
 
 # Fill SuperaAtomic class and hand off to label-making
 def run_supera(out_file='larcv.root',
@@ -92,160 +826,250 @@ def run_supera(out_file='larcv.root',
                num_skip=0,
                num_flash_skip=0,
                ignore_bad_association=True,
-               save_log=None):
+               save_log=None,
+               cache_truth=False,
+               workers=1,
+               batches_per_worker=4,
+               prefetch=0,
+               truth_index=False,
+               truth_index_dir=None,
+               column_store_dir=None,
+               block_cache_size=0,
+               rdcc_nbytes=None,
+               rdcc_nslots=None,
+               read_all_fields=False,
+               read_flashes=True,
+               flash_match='ref',
+               flash_window=(0., 0.),
+               flash_time_scale=1.,
+               output_format='larcv',
+               checkpoint_interval=0,
+               profile_file=None,
+               selection=None,
+               entries=None,
+               driver=None):
+    '''
+    Convert the events of in_file (one file or a list) into out_file.
+    selection is a dict of FlowReader.Select keyword arguments (event_ids,
+    mask, predicate); num_skip and num_events then apply to the selected
+    events. entries, if given, lists the entries to convert explicitly and
+    overrides both. driver, if given, is an already configured SuperaDriver
+    that is reused instead of building one from config_key.
+    '''
 
-    start_time = time.time()
+    setup_logging()
 
-    writer = get_iomanager(out_file)
-    driver = get_flow2supera(config_key)
-    reader = flow2supera.reader.FlowReader(driver.parser_run_config(), in_file)
-    #reader_flash = flow2supera.reader.FlowFlashReader(driver.parser_run_config(), in_file)
+    if workers > 1:
+        return run_supera_parallel(out_file=out_file,
+                                   in_file=in_file,
+                                   config_key=config_key,
+                                   num_events=num_events,
+                                   num_flash_events=num_flash_events,
+                                   num_skip=num_skip,
+                                   num_flash_skip=num_flash_skip,
+                                   ignore_bad_association=ignore_bad_association,
+                                   save_log=save_log,
+                                   cache_truth=cache_truth,
+                                   workers=workers,
+                                   batches_per_worker=batches_per_worker,
+                                   prefetch=prefetch,
+                                   truth_index=truth_index,
+                                   truth_index_dir=truth_index_dir,
+                                   column_store_dir=column_store_dir,
+                                   block_cache_size=block_cache_size,
+                                   rdcc_nbytes=rdcc_nbytes,
+                                   rdcc_nslots=rdcc_nslots,
+                                   read_all_fields=read_all_fields,
+                                   read_flashes=read_flashes,
+                                   flash_match=flash_match,
+                                   flash_window=flash_window,
+                                   flash_time_scale=flash_time_scale,
+                                   output_format=output_format,
+                                   checkpoint_interval=checkpoint_interval,
+                                   profile_file=profile_file,
+                                   selection=selection)
 
-    id_vv = ROOT.std.vector("std::vector<unsigned long>")()
-    value_vv = ROOT.std.vector("std::vector<float>")()
+    start_time = time.time()
+
+    checkpoint = Checkpoint(out_file) if checkpoint_interval > 0 else None
+    part_file = checkpoint.PartFileName() if checkpoint else out_file
+    writer = get_writer(part_file, output_format)
+    if driver is None:
+        driver = get_flow2supera(config_key)
+    else:
+        # A reused driver starts without the previous run's warnings and npz log
+        driver.warnings.Reset()
+        driver._log = None
+    reader = flow2supera.reader.FlowReader(driver.parser_run_config(), in_file,
+                                           cache_truth=cache_truth,
+                                           truth_index=truth_index,
+                                           truth_index_dir=truth_index_dir,
+                                           column_store_dir=column_store_dir,
+                                           block_cache_size=block_cache_size,
+                                           rdcc_nbytes=rdcc_nbytes,
+                                           rdcc_nslots=rdcc_nslots,
+                                           read_all_fields=read_all_fields,
+                                           read_flashes=read_flashes,
+                                           flash_match=flash_match,
+                                           flash_window=flash_window,
+                                           flash_time_scale=flash_time_scale)
 
-    id_v=ROOT.std.vector("unsigned long")()
-    value_v=ROOT.std.vector("float")()
+    # A checkpointed run profiles each part into its own file
+    profiler = flow2supera.profiler.Profiler(Checkpoint.PartProfileName(part_file) if checkpoint else profile_file,
+                                             enabled=bool(profile_file))
+    reader.profiler = profiler
+    driver.profiler = profiler
 
     if num_events < 0:
         num_events = len(reader)
-    # if num_flash_events < 0:
-    #     num_flash_events = len(reader_flash)
 
-    print("--- startup {:.2e} seconds ---".format(time.time() - start_time))
+    logger.info('--- startup %.2e seconds ---', time.time() - start_time)
 
-    LOG_KEYS  = ['event_id','time_read','time_convert','time_generate', 'time_store', 'time_event']
+    LOG_KEYS  = ['event_id']
     LOG_KEYS += ['raw_image_sum','raw_image_npx','raw_packet_sum','raw_packet_num',
     'in_cluster_sum','in_unass_sum','out_image_sum','out_image_num',
     'out_cluster_sum','out_unass_sum']
 
-    logger = dict()
+    log_data = dict()
     if save_log:
         for key in LOG_KEYS:
-            logger[key]=[]
-        driver.log(logger)
+            log_data[key]=[]
+        driver.log(log_data)
         
-    print("----------------Processing charge events----------------")
-    for entry in range(len(reader)):
-
-        if num_skip and entry < num_skip:
-            continue
+    if entries is None:
+        entries = select_entries(reader, num_skip, num_events, selection)
+    entries = np.asarray(entries, dtype=np.int64)
+    stop_entry = int(entries[-1]) + 1 if len(entries) else 0
+    if checkpoint and checkpoint.next_entry is not None:
+        logger.info('Resuming from checkpoint at entry %d', checkpoint.next_entry)
+        entries = entries[entries >= checkpoint.next_entry]
+    num_part_entries = 0
 
-        if num_events <= 0:
-            break
+    def commit_part(next_entry):
+        part_log = Checkpoint.PartLogName(part_file) if save_log else None
+        part_profile = Checkpoint.PartProfileName(part_file) if profile_file else None
+        if part_log:
+            np.savez(part_log, **log_data)
+            for values in log_data.values():
+                values.clear()
+        profiler.Close()
+        checkpoint.Commit(part_file, next_entry, part_log, part_profile)
 
-        num_events -= 1 
+    # With prefetching, reads run ahead on one thread and entries are written
+    # on another while the main thread converts and labels.
+    if prefetch > 0:
+        import ROOT
+        ROOT.EnableThreadSafety()
+        events = EventPrefetcher(reader, entries, prefetch)
+        saver = EntrySaver(writer)
+    else:
+        events = read_events(reader, entries, profiler)
+        saver = None
 
-        print(f'Processing Entry {entry}')
+    logger.info('----------------Processing charge events----------------')
+    # Per-event messages are only formatted when debugging
+    debug = logger.isEnabledFor(logging.DEBUG)
+    t0 = time.time()
+    for entry, input_data in events:
 
-        t0 = time.time()
-        input_data = reader.GetEvent(entry)
-        reader.EventDump(input_data)
+        if debug:
+            logger.debug('Processing Entry %d', entry)
+            reader.EventDump(input_data)
         #is_good_event = reader.CheckIntegrity(input_data, ignore_bad_association)
         #if not is_good_event:
         #    print('[ERROR] Entry', entry, 'is not valid; skipping')
         #    continue
-        time_read = time.time() - t0
+        if saver:
+            profiler.Record('read_wait', time.time() - t0)
+            profiler.Count('read_queue_depth', events.Depth())
         
-        t1 = time.time()
-        EventInput = driver.ReadEvent(input_data)
-        time_convert = time.time() - t1
+        with profiler.Timer('convert'):
+            EventInput = driver.ReadEvent(input_data)
 
-        t2 = time.time()
-        driver.GenerateImageMeta(EventInput)
-        driver.GenerateLabel(EventInput) 
-        time_generate = time.time() - t2
+        with profiler.Timer('generate'):
+            driver.GenerateImageMeta(EventInput)
+            driver.GenerateLabel(EventInput) 
 
         # Perform an integrity check
         if save_log:
-            log_supera_integrity_check(EventInput, driver, logger, verbose)
+            log_supera_integrity_check(EventInput, driver, log_data, debug)
 
         # Start data store process
-        t3 = time.time()
-        result = driver.Label()
-        meta   = larcv_meta(driver.Meta())
-        
-        tensor_energy = writer.get_data("sparse3d", "pcluster")
-        result.FillTensorEnergy(id_v, value_v)
-        larcv.as_event_sparse3d(tensor_energy, meta, id_v, value_v)
-        
-        tensor_packets = writer.get_data("sparse3d", "packets")
-        driver.Meta().edep2voxelset(driver._edeps_all).fill_std_vectors(id_v, value_v)
-        larcv.as_event_sparse3d(tensor_packets, meta, id_v, value_v)
-
-        tensor_semantic = writer.get_data("sparse3d", "pcluster_semantics")
-        result.FillTensorSemantic(id_v, value_v)
-        larcv.as_event_sparse3d(tensor_semantic,meta, id_v, value_v)
-
-        cluster_energy = writer.get_data("cluster3d", "pcluster")
-        result.FillClustersEnergy(id_vv, value_vv)
-        larcv.as_event_cluster3d(cluster_energy, meta, id_vv, value_vv)
-
-        cluster_dedx = writer.get_data("cluster3d", "pcluster_dedx")
-        result.FillClustersdEdX(id_vv, value_vv)
-        larcv.as_event_cluster3d(cluster_dedx, meta, id_vv, value_vv)
-
-        particle = writer.get_data("particle", "pcluster")
-        print("len particles", len(result._particles))
-        for p in result._particles:
-            if not p.valid:
-                continue
-            larp = larcv_particle(p)
-            particle.append(larp)
-            
-        #propagating trigger info
-        trigger = writer.get_data("trigger", "base")
-        trigger.id(int(input_data.event_id))  # fixme: this will need to be different for real data?
-        trigger.time_s(int(input_data.t0))
-        trigger.time_ns(int(1e9 * (input_data.t0 - trigger.time_s())))
-        
-        # TODO fill the run ID 
-        writer.set_id(0, 0, int(input_data.event_id))
-        writer.save_entry()
-        time_store = time.time() - t3
+        with profiler.Timer('store'):
+            if saver:
+                # The previous entry's products must be written before they are refilled
+                profiler.Count('store_queue_depth', saver.Depth())
+                saver.Wait()
+            writer.Store(driver, input_data)
+            if saver:
+                saver.Save()
+            else:
+                writer.Save()
+        if profiler.enabled:
+            profiler.Count('voxels', driver.Label()._energies.size())
 
         time_event = time.time() - t0
-        print("--- running driver  {:.2e} seconds ---".format(time_event))
+        if debug:
+            logger.debug('--- running driver  %.2e seconds ---', time_event)
+        profiler.Record('event', time_event)
+        profiler.EndEvent(entry)
 
         if save_log:
-            logger['event_id'].append(input_data.event_id)
-            logger['time_read'    ].append(time_read)
-            logger['time_convert' ].append(time_convert)
-            logger['time_generate'].append(time_generate)
-            logger['time_store'   ].append(time_store)
-            logger['time_event'   ].append(time_event)
-        
-#     print("----------------Processing light events----------------")
-#     for entry in range(len(reader_flash)):
-#         #FIXME: this loop also adds entry to other branches
-#         if num_flash_skip and entry < num_flash_skip:
-#             continue
-
-#         if num_flash_events <= 0:
-#             break
+            log_data['event_id'].append(input_data.event_id)
 
-#         num_flash_events -= 1 
+        # Commit the current part and start a new one
+        num_part_entries += 1
+        if checkpoint and num_part_entries == checkpoint_interval:
+            if saver:
+                saver.Close()
+            writer.Finalize()
+            commit_part(int(entry) + 1)
+            logger.info('Checkpoint: committed entries up to %d', entry)
+            part_file = checkpoint.PartFileName()
+            writer = get_writer(part_file, output_format)
+            profiler.Open(Checkpoint.PartProfileName(part_file))
+            if saver:
+                saver = EntrySaver(writer)
+            num_part_entries = 0
 
-#         print(f'Processing Entry {entry}')
+    def commit_part(next_entry):
+        part_log = Checkpoint.PartLogName(part_file) if save_log else None
+        part_profile = Checkpoint.PartProfileName(part_file) if profile_file else None
+        if part_log:
+            np.savez(part_log, **log_data)
+            for values in log_data.values():
+                values.clear()
+        profiler.Close()
+        checkpoint.Commit(part_file, next_entry, part_log, part_profile)
 
-      
-#         input_flash_data = reader_flash.GetFlash(entry)
-#         reader_flash.FlashDump(input_flash_data)
+        t0 = time.time()
 
-#         flash_data = larcv_flash(input_flash_data)
-#         flash = writer.get_data("opflash", "sipm_hits")
-#         flash.append(flash_data) 
-            
-#         writer.set_id(0, 0, int(input_flash_data.id))
-#         writer.save_entry()
+    if saver:
+        saver.Close()
+        
+    reader.CloseFile()
+    writer.Finalize()
 
+    if checkpoint:
+        if num_part_entries or not checkpoint.parts:
+            commit_part(max(stop_entry, checkpoint.next_entry or 0))
+        else:
+            profiler.Close()
+            for empty_file in (part_file, Checkpoint.PartProfileName(part_file)):
+                if os.path.isfile(empty_file):
+                    os.remove(empty_file)
+        checkpoint.Finish(WRITERS[output_format],
+                          log_file_name(save_log) if save_log else None,
+                          profile_file)
 
-    writer.finalize()
+    driver.warnings.Summary()
+    profiler.Summary()
+    profiler.Close()
 
-    if save_log:
-        np.savez('log_flow2supera.npz',**logger)
+    if save_log and not checkpoint:
+        np.savez(log_file_name(save_log),**log_data)
 
-    print("done")   
+    logger.info('done')   
 
 
 